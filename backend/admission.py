@@ -0,0 +1,280 @@
+from collections import deque
+from math import ceil
+from time import time
+import threading
+
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from backend.metrics import Histogram, LATENCY_BUCKETS, render_gauges
+from backend.upstreams import NETWORK_ERRORS
+
+
+class RetryLater(object):
+    """HTTP exception with a ``Retry-After`` header."""
+
+    def __init__(self, description=None, retry_after=1):
+        super(RetryLater, self).__init__(description)
+        self.retry_after = int(ceil(retry_after))
+
+    def get_headers(self, environ=None):
+        headers = super(RetryLater, self).get_headers(environ)
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+class UserOverloaded(RetryLater, TooManyRequests):
+    pass
+
+
+class ERPOverloaded(RetryLater, ServiceUnavailable):
+    pass
+
+
+class CircuitOpen(ERPOverloaded):
+    pass
+
+
+class CircuitBreaker(object):
+    """Fail fast while the error rate of the upstream calls is too high.
+
+    The breaker opens when at least `error_rate` of the calls of the last
+    `window` seconds failed, with `min_calls` of them. After `open_time`
+    seconds one call is let through, closing it again if it works, and
+    another one every `open_time` seconds until one of them ends.
+    """
+
+    def __init__(self, window=10, min_calls=20, error_rate=0.5, open_time=30):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_time = open_time
+        self.state = 'closed'
+        self.opened = 0
+        self.openings = 0
+        self._lock = threading.Lock()
+        # [second, calls, errors]
+        self._buckets = deque()
+
+    def configure(self, config):
+        """Read the breaker settings from a Flask config mapping."""
+        self.window = config.get('CIRCUIT_WINDOW', self.window)
+        self.min_calls = config.get('CIRCUIT_MIN_CALLS', self.min_calls)
+        self.error_rate = config.get('CIRCUIT_ERROR_RATE', self.error_rate)
+        self.open_time = config.get('CIRCUIT_OPEN_TIME', self.open_time)
+
+    def allow(self):
+        """Raise :class:`CircuitOpen` if the call must not be made."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            now = time()
+            remaining = self.opened + self.open_time - now
+            if remaining <= 0:
+                self.state = 'half_open'
+                self.opened = now
+                return
+        raise CircuitOpen(
+            'PowERP is failing, calls are stopped for a while',
+            max(remaining, 1)
+        )
+
+    def record(self, error):
+        now = time()
+        second = int(now)
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'open' if error else 'closed'
+                self.opened = now
+                self.openings += int(error)
+                self._buckets.clear()
+                return
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            self._buckets[-1][1] += 1
+            self._buckets[-1][2] += int(error)
+            while self._buckets[0][0] <= second - self.window:
+                self._buckets.popleft()
+            calls = sum(x[1] for x in self._buckets)
+            errors = sum(x[2] for x in self._buckets)
+            if (self.state == 'closed' and calls >= self.min_calls
+                    and errors >= calls * self.error_rate):
+                self.state = 'open'
+                self.opened = now
+                self.openings += 1
+
+
+class Waiter(object):
+
+    def __init__(self, user):
+        self.user = user
+        self.granted = threading.Event()
+
+
+class Limiter(object):
+    """Bound the concurrent upstream calls, sharing them fairly by user.
+
+    At most ``ADMISSION_MAX_CONCURRENT`` calls run at the same time and
+    ``ADMISSION_MAX_PER_USER`` of every user. The rest wait in a queue by
+    user. Free slots go to the waiting user with the lowest virtual time,
+    which grows by ``1 / weight`` on every call (``ADMISSION_WEIGHTS`` by
+    login, Default 1), so a user with many calls can't starve the others.
+    Calls waiting more than ``ADMISSION_TIMEOUT`` seconds get a 429 when
+    their user is at its limit and a 503 otherwise. A full queue
+    (``ADMISSION_MAX_QUEUE``) also gets a 503.
+    """
+
+    def __init__(self, max_concurrent=32, max_per_user=8, timeout=10,
+                 max_queue=1000, retry_after=5, weights=None):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.weights = weights or {}
+        self.breaker = CircuitBreaker()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._user_active = {}
+        self._queues = {}
+        self._queued = 0
+        self._vtime = {}
+        self._clock = 0
+        self._counters = {
+            'admitted': 0,
+            'rejected_user': 0,
+            'rejected_busy': 0,
+            'rejected_circuit': 0,
+        }
+        self.waits = Histogram(
+            'backend_admission_wait_seconds',
+            'Time waited for an upstream call slot.', ('result',),
+            LATENCY_BUCKETS
+        )
+
+    def configure(self, config):
+        """Read the admission settings from a Flask config mapping."""
+        self.max_concurrent = config.get(
+            'ADMISSION_MAX_CONCURRENT', self.max_concurrent
+        )
+        self.max_per_user = config.get(
+            'ADMISSION_MAX_PER_USER', self.max_per_user
+        )
+        self.timeout = config.get('ADMISSION_TIMEOUT', self.timeout)
+        self.max_queue = config.get('ADMISSION_MAX_QUEUE', self.max_queue)
+        self.retry_after = config.get(
+            'ADMISSION_RETRY_AFTER', self.retry_after
+        )
+        self.weights = config.get('ADMISSION_WEIGHTS', self.weights)
+        self.breaker.configure(config)
+
+    def _dispatch(self):
+        """Grant free slots to the waiting users, lowest virtual time first."""
+        while self._active < self.max_concurrent:
+            eligible = [
+                user for user, queue in self._queues.items()
+                if queue and self._user_active.get(user, 0) < self.max_per_user
+            ]
+            if not eligible:
+                return
+            user = min(eligible, key=lambda x: self._vtime.get(x, 0))
+            queue = self._queues[user]
+            waiter = queue.popleft()
+            if not queue:
+                del self._queues[user]
+            self._queued -= 1
+            self._clock = max(self._clock, self._vtime.get(user, 0))
+            self._vtime[user] = self._clock + 1.0 / self.weights.get(user, 1)
+            self._active += 1
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+            waiter.granted.set()
+
+    def acquire(self, user):
+        try:
+            self.breaker.allow()
+        except CircuitOpen:
+            with self._lock:
+                self._counters['rejected_circuit'] += 1
+            raise
+        start = time()
+        waiter = Waiter(user)
+        with self._lock:
+            if self._queued >= self.max_queue:
+                self._counters['rejected_busy'] += 1
+                raise ERPOverloaded(
+                    'Too many calls waiting for PowERP', self.retry_after
+                )
+            self._queues.setdefault(user, deque()).append(waiter)
+            self._queued += 1
+            self._dispatch()
+        if not waiter.granted.wait(self.timeout):
+            with self._lock:
+                granted = waiter.granted.is_set()
+                if not granted:
+                    self._queues[user].remove(waiter)
+                    if not self._queues[user]:
+                        del self._queues[user]
+                    self._queued -= 1
+                    at_limit = (
+                        self._user_active.get(user, 0) >= self.max_per_user
+                    )
+                    counter = 'rejected_user' if at_limit else 'rejected_busy'
+                    self._counters[counter] += 1
+            if not granted:
+                self.waits.observe(time() - start, 'rejected')
+                if at_limit:
+                    raise UserOverloaded(
+                        'Too many calls of {} to PowERP'.format(user),
+                        self.retry_after
+                    )
+                raise ERPOverloaded(
+                    'PowERP is busy, try again later', self.retry_after
+                )
+        with self._lock:
+            self._counters['admitted'] += 1
+        self.waits.observe(time() - start, 'admitted')
+
+    def release(self, user):
+        with self._lock:
+            self._active -= 1
+            self._user_active[user] -= 1
+            if not self._user_active[user]:
+                del self._user_active[user]
+            self._dispatch()
+
+    def limit(self, client, user):
+        """Make every call of `client` wait for a slot of `user`."""
+        if getattr(client, '_limited', False):
+            return client
+        execute = client.execute
+
+        def wrapper(obj, method, *params, **kwargs):
+            self.acquire(user)
+            error = False
+            try:
+                return execute(obj, method, *params, **kwargs)
+            except NETWORK_ERRORS:
+                error = True
+                raise
+            finally:
+                self.release(user)
+                self.breaker.record(error)
+        client.execute = wrapper
+        client._limited = True
+        return client
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['active'] = self._active
+            stats['queued'] = self._queued
+            stats['users_queued'] = len(self._queues)
+            stats['circuit_open'] = int(self.breaker.state != 'closed')
+            stats['circuit_openings'] = self.breaker.openings
+        return stats
+
+    def render(self):
+        lines = render_gauges('backend_admission', 'Admission', self.stats())
+        return lines + self.waits.render()
+
+
+limiter = Limiter()
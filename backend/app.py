@@ -3,6 +3,7 @@ import logging
 
 from flask import Flask
 from __init__ import Backend
+from backend.backend_blueprint import warm_up
 from osconf import config_from_environment
 from raven.contrib.flask import Sentry
 
@@ -35,5 +36,7 @@ for k, v in config.items():
     print('CONFIG: {0}: {1}'.format(k, v))
     if v is not None:
         application.config[k] = v
+if application.config.get('METADATA_WARMUP'):
+    warm_up(application.config)
 if __name__ == "__main__":
     application.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,103 @@
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+
+
+class CredentialCache(object):
+    """Bounded cache of already verified authorization headers.
+
+    Headers are never stored, only a salted hash of them. Failed logins are
+    remembered too, so a client repeating a bad header or guessing passwords
+    for one user doesn't reach the ERP on every request. Failures are
+    counted by client address and login, so a client can't lock a user out
+    of the other addresses.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=30,
+                 max_failures=5, failure_window=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_failures = max_failures
+        self.failure_window = failure_window
+        self.salt = os.urandom(16)
+        self._lock = threading.Lock()
+        self._valid = OrderedDict()
+        self._rejected = OrderedDict()
+        self._failures = OrderedDict()
+
+    def configure(self, config):
+        """Read the cache settings from a Flask config mapping."""
+        self.max_size = config.get('AUTH_CACHE_SIZE', self.max_size)
+        self.ttl = config.get('AUTH_CACHE_TTL', self.ttl)
+        self.negative_ttl = config.get('AUTH_NEGATIVE_TTL', self.negative_ttl)
+        self.max_failures = config.get('AUTH_MAX_FAILURES', self.max_failures)
+        self.failure_window = config.get(
+            'AUTH_FAILURE_WINDOW', self.failure_window
+        )
+
+    def calculate_key(self, header_val):
+        return sha256(self.salt + header_val.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            item = self._valid.get(key)
+            if item is None:
+                return None
+            expires, credentials = item
+            if expires < time():
+                del self._valid[key]
+                return None
+            return credentials
+
+    def set(self, key, user, password):
+        with self._lock:
+            self._valid.pop(key, None)
+            self._valid[key] = (time() + self.ttl, (user, password))
+            self._rejected.pop(key, None)
+            while len(self._valid) > self.max_size:
+                self._valid.popitem(last=False)
+
+    def succeeded(self, source):
+        with self._lock:
+            self._failures.pop(source, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._valid.pop(key, None)
+
+    def is_rejected(self, key, source=None):
+        now = time()
+        with self._lock:
+            expires = self._rejected.get(key)
+            if expires is not None:
+                if expires > now:
+                    return True
+                del self._rejected[key]
+            if source is None:
+                return False
+            failures = [
+                x for x in self._failures.get(source, [])
+                if now - x < self.failure_window
+            ]
+            if failures:
+                self._failures[source] = failures
+            else:
+                self._failures.pop(source, None)
+            return len(failures) >= self.max_failures
+
+    def add_failure(self, key, source=None):
+        now = time()
+        with self._lock:
+            self._rejected.pop(key, None)
+            self._rejected[key] = now + self.negative_ttl
+            while len(self._rejected) > self.max_size:
+                self._rejected.popitem(last=False)
+            if source is not None:
+                failures = self._failures.setdefault(source, [])
+                failures.append(now)
+                del failures[:-self.max_failures]
+                while len(self._failures) > self.max_size:
+                    self._failures.popitem(last=False)
@@ -1,27 +1,54 @@
 import base64
+import hmac
 
-from flask import Blueprint, session, g, current_app
+from flask import (
+    Blueprint, Response, session, g, current_app, request, abort
+)
 import flask_restful as restful
 import flask_login as login
 from itsdangerous import JSONWebSignatureSerializer, BadSignature
-from backend.pool import Pool
-from backend.models import Model, ModelBunch, ModelMethod, ModelIdMethod, Token
+from backend.auth import CredentialCache
+from backend.pool import pool, PoolExhausted
+from backend import metrics
+from backend.metadata import metadata
+from backend.cache import cache
+from backend.compression import compress_response
+from backend.encoding import encoder, output_json
+from backend.plans import plans
+from backend.domains import domains
+from backend.coalesce import flights
+from backend.upstreams import balancer, NETWORK_ERRORS
+from backend.admission import limiter, ERPOverloaded
+from backend.replicas import router, READ_METHODS
+from backend.validators import validators
+from backend.models import (
+    Model, ModelBunch, ModelMethod, ModelIdMethod, Token, Metadata, Batch,
+    Content, BATCH_REQUEST
+)
 import erppeek
 
 
 backend = Blueprint('blueprint', __name__)
 
 api = restful.Api()
+api.representations['application/json'] = output_json
 api.init_app(backend)
 api.add_resource(Token, 'token')
+api.add_resource(Metadata, 'metadata')
+api.add_resource(Batch, 'batch')
 api.add_resource(ModelBunch, '<string:model>')
 api.add_resource(Model, '<string:model>/<int:obj_id>')
 api.add_resource(ModelIdMethod, '<string:model>/<int:obj_id>/<string:method>')
 api.add_resource(ModelMethod, '<string:model>/<string:method>')
+api.add_resource(
+    Content, '<string:model>/<int:obj_id>/<string:field>/content'
+)
 
 login_manager = login.LoginManager()
 
-pool = Pool()
+credentials = CredentialCache()
+
+ERP_UNAVAILABLE = 'backend.erp_unavailable'
 
 
 class APIUser(login.UserMixin):
@@ -39,6 +66,18 @@ class APIUser(login.UserMixin):
 
 @login_manager.header_loader
 def load_user_from_header(header_val):
+    if (header_val.startswith('Bearer ')
+            or request.environ.get(ERP_UNAVAILABLE)):
+        # The token of /metrics, not an ERP user, or the ERP is not
+        # reachable and logging out loads the user again
+        return None
+    key = credentials.calculate_key(header_val)
+    cached = credentials.get(key)
+    if cached is not None:
+        user, password = cached
+        return connect_user(user, password, key)
+    if credentials.is_rejected(key):
+        return None
     try:
         header_val = header_val.replace('Basic ', '', 1)
         auth = header_val.split()
@@ -48,28 +87,42 @@ def load_user_from_header(header_val):
         else:
             user, password = header_val.split()
         if user == "token":
-            key = current_app.config['SECRET_KEY']
-            token_serializer = JSONWebSignatureSerializer(key)
+            secret = current_app.config['SECRET_KEY']
+            token_serializer = JSONWebSignatureSerializer(secret)
             try:
                 values = token_serializer.loads(password)
                 user = values['login']
                 password = values['password']
             except BadSignature:
                 pass
-
-        database = current_app.config['OPENERP_DATABASE']
-        server = current_app.config['OPENERP_SERVER']
-        try:
-            client = pool.connect(server=server, db=database, user=user,
-                                  password=password)
-            g.backend_cnx = client
-            session['openerp_login'] = user
-            session['openerp_password'] = password
-            return APIUser(user, password)
-        except erppeek.Error:
-            pass
+        if credentials.is_rejected(key, (request.remote_addr, user)):
+            return None
+        return connect_user(user, password, key)
     except ValueError:
-        pass
+        credentials.add_failure(key)
+
+
+def connect_user(user, password, key):
+    try:
+        client = router.connect(
+            current_app.config, user, password, request.method
+        )
+    except (PoolExhausted, ) + NETWORK_ERRORS:
+        # Overloaded or down, the credentials may be right
+        request.environ[ERP_UNAVAILABLE] = True
+        raise ERPOverloaded(
+            'No connection to PowERP available', limiter.retry_after
+        )
+    except erppeek.Error:
+        credentials.invalidate(key)
+        credentials.add_failure(key, (request.remote_addr, user))
+        return None
+    credentials.set(key, user, password)
+    credentials.succeeded((request.remote_addr, user))
+    g.backend_cnx = client
+    session['openerp_login'] = user
+    session['openerp_password'] = password
+    return APIUser(user, password)
 
 
 @login_manager.user_loader
@@ -79,8 +132,77 @@ def load_user(user_id):
     return APIUser(login, password)
 
 
+@backend.before_request
+def start_stats():
+    metrics.bind(metrics.RequestStats(request.endpoint))
+
+
+@backend.after_request
+def add_stats(response):
+    stats = metrics.current()
+    if stats is not None:
+        metrics.endpoints.add(stats)
+        response.headers['X-Upstream-Calls'] = str(stats.n_calls)
+        if current_app.config.get('SERVER_TIMING', True):
+            response.headers['Server-Timing'] = stats.server_timing()
+    return response
+
+
+@backend.after_request
+def compress(response):
+    return compress_response(
+        response, request.accept_encodings, current_app.config
+    )
+
+
+@backend.route('metrics')
+def prometheus_metrics():
+    """Request and upstream histograms, pool and caches as Prometheus text.
+
+    Only served with the ``METRICS_TOKEN`` as bearer token.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+    header = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(
+            header.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+        return Response(
+            status=401, headers={'WWW-Authenticate': 'Bearer'}
+        )
+    lines = metrics.endpoints.render()
+    lines += metrics.render_gauges('backend_pool', 'Pool', pool.stats())
+    lines += metrics.render_gauges(
+        'backend_data_cache', 'Data cache', cache.stats()
+    )
+    lines += metrics.render_gauges(
+        'backend_plan_cache', 'Read plan cache', plans.stats()
+    )
+    lines += metrics.render_gauges(
+        'backend_coalesced', 'Shared upstream reads', flights.stats()
+    )
+    lines += balancer.render()
+    lines += limiter.render()
+    lines += router.render()
+    return Response(
+        '\n'.join(lines) + '\n',
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
 @backend.teardown_request
 def unload_user(*args, **kwargs):
+    if request.environ.get(BATCH_REQUEST):
+        return
+    metrics.bind(None)
+    client = g.pop('backend_cnx', None)
+    if client is not None:
+        pool.release(client)
+        if request.method not in READ_METHODS:
+            router.wrote(
+                current_app.config['OPENERP_DATABASE'],
+                session.get('openerp_login')
+            )
     session.pop('openerp_login', None)
     session.pop('openerp_password', None)
     login.logout_user()
@@ -89,3 +211,35 @@ def unload_user(*args, **kwargs):
 @backend.record_once
 def setup_login(state):
     login_manager.init_app(state.app)
+
+
+@backend.before_app_first_request
+def setup_config():
+    pool.configure(current_app.config)
+    credentials.configure(current_app.config)
+    metadata.configure(current_app.config)
+    validators.configure(current_app.config)
+    cache.configure(current_app.config)
+    encoder.configure(current_app.config)
+    plans.configure(current_app.config)
+    domains.configure(current_app.config)
+    flights.configure(current_app.config)
+    balancer.configure(current_app.config)
+    limiter.configure(current_app.config)
+    router.configure(current_app.config)
+
+
+def warm_up(config):
+    """Load the metadata of the METADATA_WARMUP models into the cache."""
+    pool.configure(config)
+    balancer.configure(config)
+    metadata.configure(config)
+    client = pool.connect(
+        server=config['OPENERP_SERVER'], db=config['OPENERP_DATABASE'],
+        user=config['METADATA_WARMUP_USER'],
+        password=config['METADATA_WARMUP_PASSWORD']
+    )
+    try:
+        metadata.warm_up(client, config['METADATA_WARMUP'])
+    finally:
+        pool.release(client)
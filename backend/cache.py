@@ -0,0 +1,241 @@
+from collections import OrderedDict
+from hashlib import sha1
+from time import time
+from uuid import uuid4
+import threading
+
+from six.moves import cPickle as pickle
+from werkzeug.contrib.cache import (
+    BaseCache, FileSystemCache, MemcachedCache, RedisCache
+)
+
+
+class LRUCache(BaseCache):
+    """In process cache bounded by the size of its pickled values."""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= len(item[1])
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._remove(key)
+            if item is None:
+                return None
+            expires, data = item
+            if expires and expires < time():
+                return None
+            self._items[key] = item
+            self.bytes += len(data)
+        return pickle.loads(data)
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        expires = time() + timeout if timeout > 0 else 0
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return False
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (expires, data)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._items)))
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key) is not None
+
+    def has(self, key):
+        with self._lock:
+            item = self._items.get(key)
+        return item is not None and (not item[0] or item[0] >= time())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
+        return True
+
+
+def make_backend(config):
+    """Cache backend from the DATA_CACHE_* settings.
+
+    ``lru`` keeps a byte bounded cache in every process, ``filesystem``
+    shares it between processes (use a tmpfs such as ``/dev/shm`` to keep it
+    in memory) and ``redis`` or ``memcached`` share it between hosts.
+    """
+    kind = config.get('DATA_CACHE_BACKEND', 'lru')
+    prefix = config.get('DATA_CACHE_PREFIX', 'backend-data:')
+    if kind == 'lru':
+        return LRUCache(
+            max_bytes=config.get('DATA_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        )
+    if kind == 'filesystem':
+        return FileSystemCache(
+            config['DATA_CACHE_DIR'],
+            threshold=config.get('DATA_CACHE_THRESHOLD', 5000)
+        )
+    if kind == 'redis':
+        return RedisCache(
+            host=config.get('DATA_CACHE_HOST', 'localhost'),
+            port=config.get('DATA_CACHE_PORT', 6379),
+            password=config.get('DATA_CACHE_PASSWORD'),
+            db=config.get('DATA_CACHE_DB', 0),
+            key_prefix=prefix
+        )
+    if kind == 'memcached':
+        return MemcachedCache(
+            config.get('DATA_CACHE_SERVERS'), key_prefix=prefix
+        )
+    raise ValueError('Unknown DATA_CACHE_BACKEND: {}'.format(kind))
+
+
+class DataCache(object):
+    """Cache of records read to expand relations and of collection counts.
+
+    Every record is cached under a version of its (model, id), which
+    :meth:`invalidate` changes when the record is written through the API,
+    and counts under a version of their model and the user.
+    """
+
+    TIMEOUT = 10
+    COUNT_TIMEOUT = 60
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = LRUCache()
+        self.backend = backend
+        self.ttl = self.TIMEOUT
+        self.count_ttl = self.COUNT_TIMEOUT
+        self.timeouts = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'sets': 0,
+            'invalidations': 0,
+        }
+
+    def configure(self, config):
+        """Read the cache settings from a Flask config mapping."""
+        self.backend = make_backend(config)
+        self.ttl = config.get('DATA_CACHE_TTL', self.ttl)
+        self.count_ttl = config.get('DATA_CACHE_COUNT_TTL', self.count_ttl)
+        self.timeouts = config.get('DATA_CACHE_MODEL_TTL', {})
+
+    def timeout(self, model):
+        return self.timeouts.get(model, self.ttl)
+
+    @property
+    def version_timeout(self):
+        timeouts = [self.ttl, self.count_ttl]
+        timeouts.extend(self.timeouts.values())
+        return max(timeouts) + 60
+
+    @staticmethod
+    def version_key(model, res_id=None):
+        if res_id is None:
+            return '{}-version'.format(model)
+        return '{}-{}-version'.format(model, res_id)
+
+    @staticmethod
+    def calculate_key(model, ids, fields, version=None):
+        if not isinstance(ids, (list, tuple)):
+            ids = [ids]
+        ids = sorted(ids)
+        fields = sorted(fields)
+        key_args = '{}-{}-{}-{}'.format(model, ids, fields, version)
+        return sha1(key_args.encode('utf-8')).hexdigest()
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def get_many_data(self, model, ids, fields):
+        """Cached records of `ids` as a dict by id."""
+        if not ids or not self.timeout(model):
+            return {}
+        versions = self.backend.get_many(
+            *[self.version_key(model, x) for x in ids]
+        )
+        keys = [
+            self.calculate_key(model, res_id, fields, version)
+            for res_id, version in zip(ids, versions)
+        ]
+        found = dict(
+            (res_id, data)
+            for res_id, data in zip(ids, self.backend.get_many(*keys))
+            if data is not None
+        )
+        self._count('hits', len(found))
+        self._count('misses', len(ids) - len(found))
+        return found
+
+    def set_many_data(self, model, records, fields):
+        timeout = self.timeout(model)
+        if not records or not timeout:
+            return
+        ids = [x['id'] for x in records]
+        versions = self.backend.get_many(
+            *[self.version_key(model, x) for x in ids]
+        )
+        self.backend.set_many(dict(
+            (self.calculate_key(model, values['id'], fields, version), values)
+            for values, version in zip(records, versions)
+        ), timeout)
+        self._count('sets', len(records))
+
+    def calculate_count_key(self, model, domain, user):
+        """Key of a count, by user as record rules change what it counts."""
+        version = self.backend.get(self.version_key(model))
+        key_args = '{}-count-{}-{}-{}'.format(model, user, domain, version)
+        return sha1(key_args.encode('utf-8')).hexdigest()
+
+    def get_count(self, model, domain, user):
+        return self.backend.get(self.calculate_count_key(model, domain, user))
+
+    def set_count(self, model, domain, user, count):
+        key = self.calculate_count_key(model, domain, user)
+        self.backend.set(key, count, self.count_ttl)
+
+    def invalidate(self, model, ids=None):
+        """Forget the cached records `ids` of `model` and its counts."""
+        version = uuid4().hex
+        keys = [self.version_key(model)]
+        keys += [self.version_key(model, x) for x in ids or []]
+        self.backend.set_many(
+            dict((key, version) for key in keys), self.version_timeout
+        )
+        self._count('invalidations', len(keys))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        if isinstance(self.backend, LRUCache):
+            stats['bytes'] = self.backend.bytes
+            stats['items'] = len(self.backend)
+        return stats
+
+
+cache = DataCache()
@@ -0,0 +1,91 @@
+from copy import deepcopy
+import threading
+
+
+class Flight(object):
+    """A call running for the first caller and the ones waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Share one upstream call between identical calls made at the same time.
+
+    The first caller of a key runs the call and the callers arriving while it
+    runs wait for it and get a copy of its result, or its exception. Keys
+    have the server, the database and the user, so calls are only shared by
+    callers with the same access rights reading the same copy of the data.
+    Calls in a WS transaction are never shared, they see its writes.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._counters = {'calls': 0, 'shared': 0}
+
+    def configure(self, config):
+        """Read the settings from a Flask config mapping."""
+        self.enabled = config.get('COALESCE_READS', self.enabled)
+
+    @staticmethod
+    def calculate_key(model, name, args, kwargs):
+        client = model.client
+        return (
+            getattr(client, '_server', None), client._db, client.user,
+            model._name, name, repr(args), repr(sorted(kwargs.items()))
+        )
+
+    def do(self, key, func, *args, **kwargs):
+        """Result of ``func(*args, **kwargs)`` shared by the callers of `key`.
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self._counters['calls'] += 1
+            else:
+                flight.followers += 1
+                self._counters['shared'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return deepcopy(flight.result)
+        try:
+            flight.result = func(*args, **kwargs)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                followers = flight.followers
+            flight.done.set()
+        # The followers copy the result, so it can't be changed meanwhile
+        if followers:
+            return deepcopy(flight.result)
+        return flight.result
+
+    def call(self, model, name, *args, **kwargs):
+        """Call the method `name` of `model` sharing it."""
+        if getattr(model.client, 'transaction_id', None):
+            return getattr(model, name)(*args, **kwargs)
+        key = self.calculate_key(model, name, args, kwargs)
+        return self.do(key, getattr(model, name), *args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._flights)
+        return stats
+
+
+flights = SingleFlight()
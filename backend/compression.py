@@ -0,0 +1,58 @@
+import zlib
+
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+MIMETYPES = ['application/json', 'application/x-ndjson', 'text/csv']
+
+
+def compressor(encoding, level):
+    return zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+
+
+def compress_stream(chunks, encoding, level):
+    """Compress the streamed `chunks`, sending every compressed block."""
+    stream = compressor(encoding, level)
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = stream.compress(chunk)
+        if data:
+            yield data
+    yield stream.flush()
+
+
+def compress_response(response, accept_encodings, config):
+    """Compress `response` with the best encoding the client accepts.
+
+    Responses smaller than ``COMPRESS_MIN_SIZE`` bytes are sent as is and
+    streamed responses are compressed as they are sent. Compressed responses
+    get a weak ETag, as their bytes depend on the encoding.
+    """
+    level = config.get('COMPRESS_LEVEL', 6)
+    if not level or 'Content-Encoding' in response.headers:
+        return response
+    if response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    if response.mimetype not in config.get('COMPRESS_MIMETYPES', MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accept_encodings.best_match(['gzip', 'deflate'])
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get('COMPRESS_MIN_SIZE', 1024):
+            return response
+        stream = compressor(encoding, level)
+        response.set_data(stream.compress(data) + stream.flush())
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,75 @@
+from base64 import b64decode
+
+SIGNATURES = [
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'<?xml', 'application/xml'),
+]
+
+
+class Base64Content(object):
+    """Decoded bytes of a base64 value, decoded only when they are sent."""
+
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('ascii')
+        if b'\n' in data:
+            data = data.replace(b'\n', b'')
+        self.data = data
+
+    def __len__(self):
+        padding = len(self.data) - len(self.data.rstrip(b'='))
+        return len(self.data) // 4 * 3 - padding
+
+    def head(self, size=16):
+        return b64decode(self.data[:(size + 2) // 3 * 4])[:size]
+
+    def iter_bytes(self, start=0, stop=None, chunk_size=65536):
+        """Yield the bytes from `start` to `stop` in chunks."""
+        if stop is None:
+            stop = len(self)
+        chunk_size = max(chunk_size // 3, 1) * 4
+        skip = start % 3
+        pos = start // 3 * 4
+        remaining = stop - start
+        while remaining > 0:
+            chunk = b64decode(self.data[pos:pos + chunk_size])[skip:]
+            chunk = chunk[:remaining]
+            if not chunk:
+                break
+            yield chunk
+            remaining -= len(chunk)
+            pos += chunk_size
+            skip = 0
+
+
+class TextContent(object):
+    """UTF-8 bytes of a text value."""
+
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def head(self, size=16):
+        return self.data[:size]
+
+    def iter_bytes(self, start=0, stop=None, chunk_size=65536):
+        if stop is None:
+            stop = len(self)
+        for pos in range(start, stop, chunk_size):
+            yield self.data[pos:min(pos + chunk_size, stop)]
+
+
+def guess_mimetype(content, default='application/octet-stream'):
+    head = content.head()
+    for signature, mimetype in SIGNATURES:
+        if head.startswith(signature):
+            return mimetype
+    return default
@@ -0,0 +1,214 @@
+from ast import literal_eval
+from collections import OrderedDict
+from numbers import Integral
+import re
+import threading
+
+import erppeek
+import six
+from six.moves.xmlrpc_client import Fault
+
+from backend.metadata import metadata
+from backend.utils import get_fields
+
+# Same terms as erppeek, i.e. 'state = open'
+TERM_RE = re.compile(
+    r'([\w._]+)\s*'   r'(=(?:like|ilike|\?)|[<>]=?|!?=(?!=)'
+    r'|(?<= )(?:like|ilike|in|not like|not ilike|not in|child_of))' r'\s*(.*)'
+)
+OPERATORS = frozenset([
+    '=', '!=', '<>', '<', '<=', '>', '>=', '=?', '=like', '=ilike', 'like',
+    'not like', 'ilike', 'not ilike', 'in', 'not in', 'child_of',
+])
+LIST_OPERATORS = frozenset(['in', 'not in', 'child_of'])
+# Operands taken by the prefix operators
+ARITY = {'!': 1, '&': 2, '|': 2}
+MAGIC_FIELDS = frozenset([
+    'id', 'create_date', 'create_uid', 'write_date', 'write_uid',
+])
+SCALAR_TYPES = six.string_types + six.integer_types + (float, type(None))
+
+
+class DomainError(ValueError):
+    pass
+
+
+def parse_term(term):
+    """(field, operator, value) of a domain term."""
+    if isinstance(term, six.string_types):
+        match = TERM_RE.match(term.strip())
+        if not match:
+            raise DomainError('Cannot parse term {!r}'.format(term))
+        field, operator, value = match.groups()
+        try:
+            value = literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        term = (field, operator, value)
+    if not isinstance(term, (list, tuple)) or len(term) != 3:
+        raise DomainError('Invalid term {!r}'.format(term))
+    field, operator, value = term
+    if not isinstance(field, six.string_types):
+        raise DomainError('Invalid field {!r}'.format(field))
+    if not isinstance(operator, six.string_types) or \
+            operator.lower() not in OPERATORS:
+        raise DomainError('Invalid operator {!r}'.format(operator))
+    operator = operator.lower()
+    if isinstance(value, (list, tuple)):
+        if operator not in LIST_OPERATORS:
+            raise DomainError(
+                'Operator {} does not take a list'.format(operator)
+            )
+        if not all(isinstance(x, SCALAR_TYPES) for x in value):
+            raise DomainError('Invalid value {!r}'.format(value))
+        value = list(value)
+        if all(isinstance(x, Integral) and not isinstance(x, bool)
+               for x in value):
+            value = sorted(set(value))
+    elif not isinstance(value, SCALAR_TYPES):
+        raise DomainError('Invalid value {!r}'.format(value))
+    return (field, operator, value)
+
+
+def parse_domain(filter_, max_length=65536, max_terms=100,
+                 max_values=10000):
+    """Parse the `filter_` string into a domain checking its syntax.
+
+    Terms are tuples with lower case operators, erppeek terms such as
+    ``'state = open'`` are also accepted. Lists of ids are sorted without
+    duplicates. Raises :class:`DomainError` when the domain is invalid or
+    bigger than the limits.
+    """
+    if not filter_:
+        return []
+    if len(filter_) > max_length:
+        raise DomainError(
+            'Filter longer than {} characters'.format(max_length)
+        )
+    try:
+        domain = literal_eval(filter_)
+    except (ValueError, SyntaxError, TypeError, RuntimeError,
+            MemoryError) as e:
+        raise DomainError('Invalid filter: {}'.format(e))
+    if not isinstance(domain, (list, tuple)):
+        raise DomainError('The filter must be a list of terms')
+    if len(domain) > max_terms:
+        raise DomainError('Filter with more than {} terms'.format(max_terms))
+    res = []
+    n_values = 0
+    # Operands still needed, an implicit '&' joins complete domains
+    expected = 0
+    for term in domain:
+        if expected == 0:
+            expected = 1
+        if isinstance(term, six.string_types) and term in ARITY:
+            res.append(term)
+            expected += ARITY[term] - 1
+            continue
+        term = parse_term(term)
+        if isinstance(term[2], list):
+            n_values += len(term[2])
+        res.append(term)
+        expected -= 1
+    if expected:
+        raise DomainError('Missing terms of the domain operators')
+    if n_values > max_values:
+        raise DomainError(
+            'Filter with more than {} values'.format(max_values)
+        )
+    return res
+
+
+def check_fields(model, domain):
+    """Raise :class:`DomainError` if a field of `domain` is not in `model`.
+
+    Dotted fields are checked following their relations, relations that
+    can't be read are errors of the domain too.
+    """
+    for term in domain:
+        if not isinstance(term, tuple):
+            continue
+        relation = model
+        names = term[0].split('.')
+        for index, name in enumerate(names):
+            if name in MAGIC_FIELDS and index == len(names) - 1:
+                break
+            try:
+                attrs = get_fields(relation).get(name)
+            except (Fault, erppeek.Error) as e:
+                raise DomainError('Cannot read the fields of {}: {}'.format(
+                    relation._name, getattr(e, 'faultString', e)
+                ))
+            if attrs is None:
+                raise DomainError('Unknown field {} of {}'.format(
+                    name, relation._name
+                ))
+            if index < len(names) - 1:
+                if 'relation' not in attrs:
+                    raise DomainError(
+                        'Field {} of {} is not a relation'.format(
+                            name, relation._name
+                        )
+                    )
+                try:
+                    relation = model.client.model(attrs['relation'])
+                except (Fault, erppeek.Error) as e:
+                    raise DomainError('Cannot read {}: {}'.format(
+                        attrs['relation'], getattr(e, 'faultString', e)
+                    ))
+
+
+class DomainCache(object):
+    """LRU of the domains compiled from the filter argument.
+
+    Domains are keyed by the metadata version, the database, the model and
+    the filter string, so repeated filters are parsed and checked against
+    the fields of the model only once.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.max_length = 65536
+        self.max_terms = 100
+        self.max_values = 10000
+        self._lock = threading.Lock()
+        self._domains = OrderedDict()
+
+    def configure(self, config):
+        """Read the cache and limits settings from a Flask config mapping."""
+        self.max_size = config.get('FILTER_CACHE_SIZE', self.max_size)
+        self.max_length = config.get('FILTER_MAX_LENGTH', self.max_length)
+        self.max_terms = config.get('FILTER_MAX_TERMS', self.max_terms)
+        self.max_values = config.get('FILTER_MAX_VALUES', self.max_values)
+
+    @staticmethod
+    def calculate_key(model, filter_):
+        client = model.client
+        return (metadata.version(client), client._db, model._name, filter_)
+
+    def get(self, model, filter_):
+        """Domain of `filter_` for `model`, a new list every time."""
+        if not filter_:
+            return []
+        key = self.calculate_key(model, filter_)
+        with self._lock:
+            domain = self._domains.pop(key, None)
+            if domain is not None:
+                self._domains[key] = domain
+        if domain is None:
+            domain = parse_domain(
+                filter_, self.max_length, self.max_terms, self.max_values
+            )
+            check_fields(model, domain)
+            with self._lock:
+                self._domains[key] = domain
+                while len(self._domains) > self.max_size:
+                    self._domains.popitem(last=False)
+        return list(domain)
+
+    def clear(self):
+        with self._lock:
+            self._domains.clear()
+
+
+domains = DomainCache()
@@ -0,0 +1,91 @@
+from base64 import b64encode
+from datetime import date, datetime, time
+from decimal import Decimal
+import json
+
+from flask import current_app
+from six.moves.xmlrpc_client import Binary, DateTime
+
+from backend import metrics
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """JSON value of the types that ERP values can have."""
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, DateTime):
+        return datetime.strptime(obj.value, '%Y%m%dT%H:%M:%S').isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, Binary):
+        return b64encode(obj.data).decode('ascii')
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+def dumps_json(obj):
+    return json.dumps(
+        obj, default=default, separators=(',', ':'), ensure_ascii=False
+    ).encode('utf-8')
+
+
+def dumps_orjson(obj):
+    return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class Encoder(object):
+    """JSON encoder of the responses.
+
+    ``orjson`` is used when it is installed, the standard :mod:`json` module
+    otherwise. ``JSON_ENCODER`` selects one of :attr:`encoders` by name.
+    """
+
+    encoders = {'json': dumps_json}
+    if orjson is not None:
+        encoders['orjson'] = dumps_orjson
+
+    def __init__(self):
+        self.name = 'orjson' if orjson is not None else 'json'
+
+    def configure(self, config):
+        """Read the encoder settings from a Flask config mapping."""
+        name = config.get('JSON_ENCODER', self.name)
+        if name not in self.encoders:
+            raise ValueError('Unknown JSON_ENCODER: {}'.format(name))
+        self.name = name
+
+    def dumps(self, obj):
+        """Encode `obj` as UTF-8 JSON bytes."""
+        return self.encoders[self.name](obj)
+
+
+encoder = Encoder()
+
+
+@metrics.timed('encode')
+def jsonify(*args, **kwargs):
+    """Same as :func:`flask.jsonify` with the :data:`encoder`."""
+    if args and kwargs:
+        raise TypeError('jsonify() takes args or kwargs, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return current_app.response_class(
+        encoder.dumps(data) + b'\n', mimetype='application/json'
+    )
+
+
+def output_json(data, code, headers=None):
+    """Flask-RESTful representation of JSON with the :data:`encoder`."""
+    response = jsonify(data)
+    response.status_code = code
+    response.headers.extend(headers or {})
+    return response
@@ -0,0 +1,114 @@
+from hashlib import sha1
+from time import time
+import threading
+
+from six.moves.xmlrpc_client import Fault
+from werkzeug.contrib.cache import SimpleCache, FileSystemCache
+
+
+class MetadataCache(object):
+    """Long lived cache for ``fields_get`` and ``default_get`` by user.
+
+    Entries are stored under a version made of a fingerprint of the
+    installed ERP modules and a generation counter, so upgrading a module
+    or calling :meth:`invalidate` makes every previous entry unreachable.
+    Users that can't read the modules keep the last fingerprint read.
+    Using a :class:`FileSystemCache` (``METADATA_CACHE_DIR``) shares the
+    entries and the generation between worker processes.
+    """
+
+    GENERATION_KEY = 'metadata_generation'
+
+    def __init__(self, backend=None, timeout=86400, check_interval=300):
+        if backend is None:
+            backend = SimpleCache()
+        self.backend = backend
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._fingerprints = {}
+
+    def configure(self, config):
+        """Read the cache settings from a Flask config mapping."""
+        self.timeout = config.get('METADATA_CACHE_TIMEOUT', self.timeout)
+        self.check_interval = config.get(
+            'METADATA_CHECK_INTERVAL', self.check_interval
+        )
+        cache_dir = config.get('METADATA_CACHE_DIR')
+        if cache_dir and not isinstance(self.backend, FileSystemCache):
+            self.backend = FileSystemCache(
+                cache_dir, default_timeout=self.timeout
+            )
+
+    @staticmethod
+    def fingerprint(client):
+        modules = client.read(
+            'ir.module.module', [('state', '=', 'installed')],
+            'name latest_version'
+        ) or []
+        modules = sorted(
+            '{}-{}'.format(x['name'], x['latest_version']) for x in modules
+        )
+        return sha1(','.join(modules).encode('utf-8')).hexdigest()
+
+    def version(self, client):
+        db = client._db
+        now = time()
+        with self._lock:
+            checked, version = self._versions.get(db, (0, None))
+        if now - checked < self.check_interval:
+            return version
+        generation = self.backend.get(self.GENERATION_KEY) or 0
+        try:
+            fingerprint = self.fingerprint(client)
+        except Fault:
+            with self._lock:
+                fingerprint = self._fingerprints.get(db, '')
+        else:
+            with self._lock:
+                self._fingerprints[db] = fingerprint
+        version = '{}-{}'.format(fingerprint, generation)
+        with self._lock:
+            self._versions[db] = (now, version)
+        return version
+
+    def invalidate(self):
+        generation = self.backend.get(self.GENERATION_KEY) or 0
+        self.backend.set(self.GENERATION_KEY, generation + 1, timeout=0)
+        with self._lock:
+            self._versions = {}
+
+    def calculate_key(self, model, kind, *args):
+        client = model.client
+        key_args = '{}-{}-{}-{}-{}'.format(
+            self.version(client), client._db, model._name, kind, args
+        ).encode('utf-8')
+        return sha1(key_args).hexdigest()
+
+    def fields_get(self, model):
+        # Readonly, states and labels depend on the rights and language
+        key = self.calculate_key(model, 'fields', model.client.user)
+        fields = self.backend.get(key)
+        if fields is None:
+            fields = model.fields_get()
+            self.backend.set(key, fields, self.timeout)
+        return fields
+
+    def default_get(self, model, fields):
+        fields = sorted(fields)
+        key = self.calculate_key(model, 'defaults', model.client.user, fields)
+        defaults = self.backend.get(key)
+        if defaults is None:
+            defaults = model.default_get(fields)
+            self.backend.set(key, defaults, self.timeout)
+        return defaults
+
+    def warm_up(self, client, models):
+        for name in models:
+            model = client.model(name)
+            fields = self.fields_get(model)
+            self.default_get(model, list(fields.keys()))
+
+
+metadata = MetadataCache()
@@ -0,0 +1,291 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+import threading
+
+_local = threading.local()
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+SIZE_BUCKETS = (
+    1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216
+)
+CALLS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class RequestStats(object):
+    """Upstream calls made and time spent while serving one request."""
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.start = time()
+        self.calls = []
+        self.timings = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, model, method, duration, size=0):
+        with self._lock:
+            self.calls.append((model, method, duration, size))
+
+    def add_timing(self, name, duration):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0) + duration
+
+    @property
+    def n_calls(self):
+        return len(self.calls)
+
+    @property
+    def duration(self):
+        return time() - self.start
+
+    def server_timing(self):
+        """Value of the ``Server-Timing`` header with the time by phase.
+
+        Upstream calls are grouped by method. Phases include the calls made
+        inside them.
+        """
+        methods = OrderedDict()
+        with self._lock:
+            for _model, method, duration, _size in self.calls:
+                n, total = methods.get(method, (0, 0))
+                methods[method] = (n + 1, total + duration)
+            timings = list(self.timings.items())
+        res = [
+            'rpc-{};dur={:.1f};desc="{} calls"'.format(
+                method, total * 1000, n
+            )
+            for method, (n, total) in methods.items()
+        ]
+        res += [
+            '{};dur={:.1f}'.format(name, duration * 1000)
+            for name, duration in timings
+        ]
+        res.append('total;dur={:.1f}'.format(self.duration * 1000))
+        return ', '.join(res)
+
+
+def format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+class Histogram(object):
+    """Prometheus histogram of observations by label values."""
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * len(self.buckets)
+                counts += [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.description),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        with self._lock:
+            values = sorted(
+                (labels, list(counts))
+                for labels, counts in self._values.items()
+            )
+        for labels, counts in values:
+            labels = list(zip(self.labels, labels))
+            bounds = list(self.buckets) + ['+Inf']
+            for bound, count in zip(bounds, counts[:-2] + [counts[-2]]):
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    self.name, format_labels(labels + [('le', bound)]), count
+                ))
+            lines.append('{}_sum{{{}}} {}'.format(
+                self.name, format_labels(labels), counts[-1]
+            ))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, format_labels(labels), counts[-2]
+            ))
+        return lines
+
+
+class EndpointStats(object):
+    """Histograms of the requests and the upstream calls by endpoint."""
+
+    def __init__(self):
+        self.requests = Histogram(
+            'backend_request_duration_seconds',
+            'Time to serve a request.', ('endpoint',), LATENCY_BUCKETS
+        )
+        self.request_calls = Histogram(
+            'backend_request_upstream_calls',
+            'Upstream calls made to serve a request.', ('endpoint',),
+            CALLS_BUCKETS
+        )
+        self.calls = Histogram(
+            'backend_upstream_call_duration_seconds',
+            'Time of the upstream calls.', ('model', 'method'),
+            LATENCY_BUCKETS
+        )
+        self.sizes = Histogram(
+            'backend_upstream_response_bytes',
+            'Size of the upstream responses.', ('method',), SIZE_BUCKETS
+        )
+        self.histograms = [
+            self.requests, self.request_calls, self.calls, self.sizes
+        ]
+
+    def add(self, stats):
+        self.requests.observe(stats.duration, stats.endpoint)
+        self.request_calls.observe(stats.n_calls, stats.endpoint)
+        for model, method, duration, size in list(stats.calls):
+            self.calls.observe(duration, model, method)
+            self.sizes.observe(size, method)
+
+    def summary(self):
+        res = {}
+        with self.request_calls._lock:
+            values = list(self.request_calls._values.items())
+        for (endpoint, ), counts in values:
+            requests, calls = counts[-2], counts[-1]
+            res[endpoint] = {
+                'requests': requests,
+                'calls': calls,
+                'calls_per_request': float(calls) / requests
+            }
+        return res
+
+    def render(self):
+        """Histograms in the Prometheus text format."""
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.render()
+        return lines
+
+
+endpoints = EndpointStats()
+
+
+def render_gauges(name, description, values):
+    """Prometheus gauges `name`_<key> of the `values` dict."""
+    lines = []
+    for key, value in sorted(values.items()):
+        metric = '{}_{}'.format(name, key)
+        lines += [
+            '# HELP {} {} {}.'.format(metric, description, key),
+            '# TYPE {} gauge'.format(metric),
+            '{} {}'.format(metric, value),
+        ]
+    return lines
+
+
+def current():
+    return getattr(_local, 'stats', None)
+
+
+def bind(stats):
+    """Make `stats` the recorder of the current thread."""
+    previous = current()
+    _local.stats = stats
+    return previous
+
+
+@contextmanager
+def timer(name):
+    """Add the time spent in the block to the `name` phase of the request."""
+    stats = current()
+    start = time()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.add_timing(name, time() - start)
+
+
+def timed(name):
+    """Decorator adding the time of every call to the `name` phase."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_received(size):
+    _local.received = getattr(_local, 'received', 0) + size
+
+
+def received():
+    """Bytes received from upstream by this thread."""
+    return getattr(_local, 'received', 0)
+
+
+class CountingResponse(object):
+    """HTTP response that counts the bytes read from it."""
+
+    def __init__(self, response):
+        self._response = response
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        add_received(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def meter(client):
+    """Count the bytes received by the XML-RPC services of `client`."""
+    for service in list(vars(client).values()):
+        proxy = getattr(getattr(service, '_dispatch', None), '__self__', None)
+        transport = getattr(proxy, '_ServerProxy__transport', None)
+        if transport is None or getattr(transport, '_metered', False):
+            continue
+        transport.parse_response = counting(transport.parse_response)
+        transport._metered = True
+
+
+def counting(parse_response):
+    def wrapper(response):
+        return parse_response(CountingResponse(response))
+    return wrapper
+
+
+def instrument(client):
+    """Record every ``execute`` of `client` in the current recorder."""
+    if getattr(client, '_instrumented', False):
+        return client
+    meter(client)
+    execute = client.execute
+
+    def wrapper(obj, method, *params, **kwargs):
+        start = time()
+        size = received()
+        try:
+            return execute(obj, method, *params, **kwargs)
+        finally:
+            stats = current()
+            if stats is not None:
+                stats.record(
+                    obj, method, time() - start, received() - size
+                )
+    client.execute = wrapper
+    client._instrumented = True
+    return client
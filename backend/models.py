@@ -1,16 +1,138 @@
-from ast import literal_eval
+from hashlib import sha1
+from itertools import chain
+from numbers import Integral
+import csv
+
+import six
+from six.moves import StringIO
 from six.moves.xmlrpc_client import Fault
-from flask import jsonify, current_app, g, request
+from flask import (
+    json, current_app, g, request, Response, stream_with_context, url_for
+)
 import flask_restful as restful
 from flask_restful import reqparse
 import flask_login as login
 import flask_cors as cors
 from itsdangerous import JSONWebSignatureSerializer
+from werkzeug.exceptions import HTTPException
 
 from backend.utils import (
-    recursive_crud, flatdot, unflatdot, normalize, make_schema
+    recursive_crud, normalize, normalize_many, get_fields, export_items,
+    dotted_value, search_read, Background, is_plain, create_many,
+    WSTransaction, LAST_UPDATE, extra_connection, cacheable, invalidate
 )
-from backend.validators import OpenERPValidator
+from backend.cache import cache
+from backend.encoding import encoder, jsonify
+from backend.pool import pool
+from backend.pagination import Cursor, CursorError, format_order
+from backend.validators import validators
+from backend.metadata import metadata
+from backend.coalesce import flights
+from backend.domains import domains
+from backend.plans import plans
+from backend.profiling import profiled
+from backend.content import Base64Content, TextContent, guess_mimetype
+
+
+def add_content_urls(model, values, fields):
+    """Set the lazy `fields` of `values` to the URL of their content."""
+    for field in fields:
+        values[field] = url_for(
+            '.content', model=model._name, obj_id=values['id'], field=field
+        )
+    return values
+
+
+def csv_rows(items, fields):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in chain([fields], (
+        [csv_value(dotted_value(values, x)) for x in fields]
+        for values in items
+    )):
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def csv_value(value):
+    if isinstance(value, dict):
+        value = value.get('id')
+    if isinstance(value, list):
+        value = ','.join(
+            six.text_type(csv_value(x)) for x in value if x is not None
+        )
+    if value is None:
+        value = ''
+    if six.PY2 and isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    return value
+
+
+def ndjson_records(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield line.decode('utf-8', 'replace')
+
+
+def fault_result(fault):
+    return {'status': 'ERROR', 'errors': {'record': fault.faultString}}
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def count_in_background(model, domain):
+    """Start a search_count with another pooled connection of the user."""
+    client = extra_connection()
+    if client is None:
+        return None
+
+    def count():
+        try:
+            return flights.call(
+                client.model(model._name), 'search_count', domain
+            )
+        finally:
+            pool.release(client)
+    return Background(count)
+
+
+def request_etag(model, *values):
+    """Strong ETag of the request arguments, the user and `values`."""
+    key_args = '{}-{}-{}-{}'.format(
+        login.current_user.login, model._name,
+        sorted(request.args.items(multi=True)), values
+    )
+    return sha1(key_args.encode('utf-8')).hexdigest()
+
+
+def with_etag(response, model, etag):
+    response.set_etag(etag)
+    cache_control = current_app.config.get('CACHE_CONTROL_MODEL', {})
+    default = current_app.config.get('CACHE_CONTROL', 'private, no-cache')
+    response.headers['Cache-Control'] = cache_control.get(
+        model._name, default
+    )
+    return response
+
+
+def not_modified(model, etag):
+    return with_etag(Response(status=304), model, etag)
 
 
 def get_model(model):
@@ -22,8 +144,94 @@ def get_model(model):
     return model
 
 
+BATCH_REQUEST = 'backend.batch'
+# Fields with a content to stream
+CONTENT_TYPES = ('binary', 'char', 'text')
+
+
+def dispatch(app, user, base, sub, client=None):
+    """Run the sub request `sub` of a batch with the API resources.
+
+    Returns the status and the body of its response. With `client` the sub
+    request uses it instead of the batch connection and releases it.
+    """
+    try:
+        with app.test_request_context(
+            base + sub.get('path', '').lstrip('/'),
+            method=sub.get('method', 'GET').upper(),
+            query_string=sub.get('args'), json=sub.get('body'),
+            environ_overrides={BATCH_REQUEST: True}
+        ) as ctx:
+            ctx.user = user
+            if client is not None:
+                g.backend_cnx = client
+            try:
+                if request.routing_exception is not None:
+                    raise request.routing_exception
+                if request.url_rule.endpoint == request.blueprint + '.batch':
+                    restful.abort(400, message='Batches can not be nested')
+                view = app.view_functions[request.url_rule.endpoint]
+                response = app.make_response(view(**request.view_args))
+            except HTTPException as e:
+                response = jsonify(getattr(e, 'data', None) or {
+                    'status': 'ERROR', 'message': e.description
+                })
+                response.status_code = e.code
+            except Fault as e:
+                response = jsonify(fault_result(e))
+                response.status_code = 500
+            except Exception as e:
+                app.logger.exception('Error in a batch request')
+                response = jsonify({'status': 'ERROR', 'message': str(e)})
+                response.status_code = 500
+            if response.is_json:
+                body = response.get_json()
+            else:
+                body = response.get_data(as_text=True)
+            return {'status': response.status_code, 'body': body}
+    finally:
+        if client is not None:
+            pool.release(client)
+
+
+def dispatch_reads(app, user, base, subs):
+    """Run the GET sub requests `subs` at the same time.
+
+    Up to BATCH_CONCURRENCY of them run with other pooled connections of the
+    user, the rest with the batch connection one after another.
+    """
+    concurrency = current_app.config.get('BATCH_CONCURRENCY', 4)
+    timeout = current_app.config.get('BATCH_TIMEOUT', 30)
+    background = {}
+    for index, sub in enumerate(subs[1:], 1):
+        if len(background) >= concurrency - 1:
+            break
+        client = extra_connection()
+        if client is None:
+            break
+        background[index] = Background(
+            dispatch, app, user, base, sub, client=client
+        )
+    results = []
+    for index, sub in enumerate(subs):
+        if index not in background:
+            results.append(dispatch(app, user, base, sub))
+        else:
+            results.append(None)
+    for index, job in background.items():
+        try:
+            results[index] = job.result(timeout)
+        except HTTPException as e:
+            results[index] = {'status': e.code, 'body': {
+                'status': 'ERROR', 'message': e.description
+            }}
+    return results
+
+
 class BaseResource(restful.Resource):
-    method_decorators = [login.login_required, cors.cross_origin()]
+    method_decorators = [
+        profiled, login.login_required, cors.cross_origin()
+    ]
 
     def options(self):
         return jsonify({})
@@ -40,6 +248,23 @@ class Token(BaseResource):
         return jsonify({'token': token})
 
 
+class Metadata(BaseResource):
+    def delete(self):
+        """
+            Invalidate the cached models metadata
+
+            :return: Response with the result of the action
+            :rtype: Response
+        """
+        user = login.current_user
+        if user.login not in current_app.config.get('ADMIN_USERS', ['admin']):
+            response = jsonify({'status': 'ERROR'})
+            response.status_code = 403
+            return response
+        metadata.invalidate()
+        return jsonify({'status': 'OK'})
+
+
 class Model(BaseResource):
 
     def get(self, model, obj_id):
@@ -60,14 +285,29 @@ class Model(BaseResource):
             type=str, help='Schema for dumping the JSON'
         )
         args = parser.parse_args()
-        schema = args.schema
-        if schema:
-            schema = [x.strip() for x in schema.split(',')]
-        else:
-            schema = model.fields_get().keys()
-        schema = unflatdot(schema)
-        result = normalize(model, model.read(obj_id, schema.keys()), schema)
-        return jsonify(result)
+        plan = plans.get(model, args.schema)
+        fields = list(plan.fields)
+        fingerprint = plan.fingerprint
+        if fingerprint:
+            if request.if_none_match:
+                stamp = flights.call(
+                    model, 'read', obj_id, [LAST_UPDATE]
+                )[LAST_UPDATE]
+                etag = request_etag(model, obj_id, stamp)
+                if request.if_none_match.contains_weak(etag):
+                    return not_modified(model, etag)
+            fields.append(LAST_UPDATE)
+        values = flights.call(model, 'read', obj_id, fields)
+        if fingerprint:
+            etag = request_etag(model, obj_id, values.pop(LAST_UPDATE))
+        values = normalize(model, values, plan)
+        add_content_urls(model, values, plan.lazy)
+        response = jsonify(values)
+        if not fingerprint:
+            etag = sha1(response.get_data()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(model, etag)
+        return with_etag(response, model, etag)
 
     def patch(self, model, obj_id):
         """
@@ -83,9 +323,7 @@ class Model(BaseResource):
         model = get_model(model)
         data = request.json
         data['id'] = obj_id
-        fields = flatdot(data)
-        schema = make_schema(model, fields)
-        validator = OpenERPValidator(schema)
+        validator = validators.get_validator(model, data)
         if not validator.validate(data, update=True):
             response = {
                 'status': 'ERROR',
@@ -117,6 +355,7 @@ class Model(BaseResource):
             return response
         else:
             model.unlink(found)
+            invalidate(model, found)
             return jsonify({'status': 'OK'})
 
 
@@ -132,10 +371,12 @@ class ModelBunch(BaseResource):
             :rtype: Response
         """
         model = get_model(model)
+        if request.mimetype == 'application/x-ndjson':
+            return self.bulk(model, ndjson_records(request.stream))
         data = request.json
-        fields = flatdot(data)
-        schema = make_schema(model, fields)
-        validator = OpenERPValidator(schema)
+        if isinstance(data, list):
+            return self.bulk(model, data)
+        validator = validators.get_validator(model, data)
         if not validator.validate(data, update=True):
             response = {
                 'status': 'ERROR',
@@ -148,6 +389,75 @@ class ModelBunch(BaseResource):
             resp = jsonify({'status': 'OK', 'id': res_id})
         return resp
 
+    def bulk(self, model, records):
+        """
+            Create or update many records in one transaction
+
+            Records are validated and written in chunks, new records without
+            nested records are created together. If any record fails
+            nothing is written.
+
+            :param model: Model
+            :param records: Iterable of records, with id to update them
+            :return: Response with the result of every record
+            :rtype: Response
+        """
+        chunk_size = current_app.config.get('BULK_CHUNK_SIZE', 200)
+        results = []
+        with WSTransaction() as transaction:
+            for chunk in chunks(enumerate(records), chunk_size):
+                valid = []
+                for index, data in chunk:
+                    if not isinstance(data, dict):
+                        results.append({
+                            'status': 'ERROR', 'errors': {'record': str(data)}
+                        })
+                        continue
+                    validator = validators.get_validator(model, data)
+                    if not validator.validate(data):
+                        results.append({
+                            'status': 'ERROR', 'errors': validator.errors
+                        })
+                    else:
+                        results.append({'status': 'OK'})
+                        valid.append((index, data))
+                if len(valid) < len(chunk):
+                    transaction.errors.append(chunk[0][0])
+                if transaction.errors:
+                    continue
+                plain = [x for x in valid if is_plain(model, x[1])]
+                try:
+                    if plain:
+                        res_ids = create_many(model, [x[1] for x in plain])
+                        for (index, _), res_id in zip(plain, res_ids):
+                            results[index]['id'] = res_id
+                except Fault as e:
+                    transaction.errors.append(e)
+                    for index, _ in plain:
+                        results[index] = fault_result(e)
+                    continue
+                for index, data in valid:
+                    if 'id' in results[index]:
+                        continue
+                    try:
+                        results[index]['id'] = recursive_crud(model, data)
+                    except Fault as e:
+                        transaction.errors.append(e)
+                        results[index] = fault_result(e)
+                        break
+        if transaction.errors:
+            for res in results:
+                if res['status'] == 'OK':
+                    res['status'] = 'ROLLBACK'
+                    res.pop('id', None)
+        resp = jsonify({
+            'status': 'ERROR' if transaction.errors else 'OK',
+            'results': results
+        })
+        if transaction.errors:
+            resp.status_code = 422
+        return resp
+
     def get(self, model):
         """
             Get a collection of record of the model
@@ -168,7 +478,7 @@ class ModelBunch(BaseResource):
             type=str, help='Schema for dumping the JSON'
         )
         parser.add_argument(
-            'limit', dest='limit', default=80,
+            'limit', dest='limit',
             type=int, help='Limit results'
         )
         parser.add_argument(
@@ -179,47 +489,250 @@ class ModelBunch(BaseResource):
             'order', dest='order', default='',
             type=str, help='Results sorting criteria in sql syntax'
         )
+        parser.add_argument(
+            'format', dest='format', default='json',
+            choices=('json', 'ndjson', 'csv'), help='Response format'
+        )
+        parser.add_argument(
+            'cursor', dest='cursor',
+            type=str, help='Cursor of the page, empty for the first one'
+        )
+        parser.add_argument(
+            'count', dest='count', default='true',
+            choices=('true', 'false', 'estimate'),
+            help='How to compute the number of items'
+        )
         args = parser.parse_args()
-        limit = args.limit
+        if args.format != 'json':
+            return self.export(model, args)
+        limit = args.limit if args.limit is not None else 80
         offset = args.offset
         order = args.order
-        if args.filter:
-            try:
-                search_params = literal_eval(args.filter)
-            except (ValueError, SyntaxError) as e:
-                response = jsonify({
-                    'status': 'ERROR',
-                    'errors': {'filter': e.message}
-                })
-                response.status_code = 422
-                return response
-        else:
-            search_params = []
+        cursor = None
+        plan = plans.get(model, args.schema)
+        try:
+            search_params = domains.get(model, args.filter)
+            page_params = search_params
+            if args.cursor is not None:
+                secret = current_app.config['SECRET_KEY']
+                cursor = Cursor(secret, order, plan.fields_def)
+                page_params = search_params + cursor.domain(args.cursor)
+                order = format_order(cursor.order)
+                offset = 0
+        except (ValueError, SyntaxError) as e:
+            key = 'cursor' if isinstance(e, CursorError) else 'filter'
+            response = jsonify({
+                'status': 'ERROR',
+                'errors': {key: str(e)}
+            })
+            response.status_code = 422
+            return response
+        fields = plan.fields
+        extra_fields = []
+        if cursor is not None:
+            extra_fields = [
+                x for x in cursor.sort_fields
+                if x != 'id' and x not in plan.schema
+            ]
+        fingerprint = plan.fingerprint
+        count = None
+        res_ids = None
         try:
-            count = model.search_count(search_params)
-            res_ids = model.search(search_params, limit=limit, offset=offset, order=order)
+            if fingerprint:
+                extra_fields.append(LAST_UPDATE)
+                if request.if_none_match:
+                    res_ids = flights.call(
+                        model, 'search', page_params, limit=limit,
+                        offset=offset, order=order
+                    )
+                    stamps = res_ids and flights.call(
+                        model, 'read', res_ids, [LAST_UPDATE], order=True
+                    ) or []
+                    count = self.count(
+                        model, search_params, args.count, res_ids, limit,
+                        None if cursor else offset
+                    )
+                    etag = request_etag(model, count, [
+                        (x['id'], x[LAST_UPDATE]) for x in stamps if x
+                    ])
+                    if request.if_none_match.contains_weak(etag):
+                        return not_modified(model, etag)
+            pending = None
+            if count is None and (args.count == 'true' or (
+                    args.count == 'estimate'
+                    and cache.get_count(
+                        model._name, search_params, model.client.user
+                    ) is None)):
+                pending = count_in_background(model, search_params)
+            if res_ids is None:
+                items = search_read(
+                    model, page_params, fields + extra_fields, offset=offset,
+                    limit=limit, order=order
+                )
+            else:
+                # The page was already searched to compute the ETag
+                items = res_ids and flights.call(
+                    model, 'read', res_ids, fields + extra_fields, order=True
+                ) or []
+                items = [x for x in items if x]
+            res_ids = [x['id'] for x in items]
+            if count is None:
+                count = self.count(
+                    model, search_params, args.count, res_ids, limit,
+                    None if cursor else offset, pending
+                )
         except Fault:
             response = jsonify({'status': 'ERROR'})
             response.status_code = 422
             return response
+        if fingerprint:
+            etag = request_etag(model, count, [
+                (x['id'], x[LAST_UPDATE]) for x in items
+            ])
         normalized_items = []
-        if res_ids:
-            if args.schema:
-                schema = [x.strip() for x in args.schema.split(',')]
-            else:
-                schema = list(model.fields_get().keys())
-            schema = unflatdot(schema)
-            fields = list(schema.keys())
-            items = model.read(res_ids, fields=fields, limit=limit, offset=offset)
-            if items:
-                for values in items:
-                    normalized_items.append(normalize(model, values, schema))
-        return jsonify({
+        next_cursor = None
+        if items:
+            if cursor is not None and len(items) == limit:
+                next_cursor = cursor.dumps(items[-1])
+            for values in items:
+                for field in extra_fields:
+                    values.pop(field, None)
+            normalized_items = normalize_many(model, items, plan)
+            for values in normalized_items:
+                add_content_urls(model, values, plan.lazy)
+        res = {
             'items': normalized_items,
             'n_items': count,
             'limit': limit,
             'offset': offset
-        })
+        }
+        if cursor is not None:
+            res['cursor'] = next_cursor
+        response = jsonify(res)
+        if not fingerprint:
+            etag = sha1(response.get_data()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                return not_modified(model, etag)
+        return with_etag(response, model, etag)
+
+    @staticmethod
+    def count(model, domain, mode, res_ids, limit, offset=None, pending=None):
+        """
+            Number of items of the collection
+
+            :param mode: true, false or estimate
+            :param offset: Offset of the page, None when it is not known
+            :param pending: Count already running in background
+            :return: The number of items or None when not asked
+        """
+        if mode == 'false':
+            return None
+        if offset is not None and len(res_ids) < limit and (
+                res_ids or not offset):
+            return offset + len(res_ids)
+        if mode == 'estimate':
+            count = cache.get_count(model._name, domain, model.client.user)
+            if count is not None:
+                return count
+        if pending is not None:
+            count = pending.result()
+        else:
+            count = flights.call(model, 'search_count', domain)
+        if cacheable(model.client):
+            cache.set_count(model._name, domain, model.client.user, count)
+        return count
+
+    def export(self, model, args):
+        """
+            Stream all the records of the collection as NDJSON or CSV
+
+            :param model: Model
+            :param args: Parsed request arguments
+            :return: Streamed response
+            :rtype: Response
+        """
+        try:
+            search_params = domains.get(model, args.filter)
+            res_ids = model.search(
+                search_params, limit=args.limit, offset=args.offset,
+                order=args.order
+            )
+        except (ValueError, SyntaxError, Fault) as e:
+            response = jsonify({
+                'status': 'ERROR',
+                'errors': {'filter': str(e)}
+            })
+            response.status_code = 422
+            return response
+        plan = plans.get(model, args.schema)
+        chunk_size = current_app.config.get('EXPORT_CHUNK_SIZE', 500)
+        items = export_items(model, res_ids or [], plan, chunk_size)
+        if plan.lazy:
+            items = (add_content_urls(model, x, plan.lazy) for x in items)
+        if args.format == 'ndjson':
+            rows = (encoder.dumps(values) + b'\n' for values in items)
+            mimetype = 'application/x-ndjson'
+        else:
+            rows = csv_rows(items, plan.columns)
+            mimetype = 'text/csv'
+        return Response(stream_with_context(rows), mimetype=mimetype)
+
+
+class Content(BaseResource):
+
+    def get(self, model, obj_id, field):
+        """
+            Stream the content of a field of the element with id = obj_id
+
+            Only binary, char and text fields have content, binary fields
+            are decoded in chunks while they are sent. A single byte range
+            can be asked with the Range header.
+
+            :param model: Model name
+            :type model: str
+            :param obj_id: Element Id
+            :type obj_id: str
+            :param field: Field name
+            :type field: str
+            :return: Streamed response with the content
+            :rtype: Response
+        """
+        model = get_model(model)
+        attrs = get_fields(model).get(field)
+        if attrs is not None and attrs['type'] not in CONTENT_TYPES:
+            attrs = None
+        values = attrs and model.read([obj_id], [field])
+        if not values:
+            response = jsonify({'status': 'ERROR'})
+            response.status_code = 404
+            return response
+        value = values[0][field] or ''
+        if attrs['type'] == 'binary':
+            content = Base64Content(value)
+            mimetype = guess_mimetype(content)
+        else:
+            content = TextContent(value)
+            mimetype = guess_mimetype(content, 'text/plain')
+        length = len(content)
+        start, stop = 0, length
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+        if request.range is not None and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(length)
+            if byte_range is None:
+                headers['Content-Range'] = 'bytes */{}'.format(length)
+                return Response(status=416, headers=headers)
+            start, stop = byte_range
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, stop - 1, length
+            )
+        headers['Content-Length'] = str(stop - start)
+        chunk_size = current_app.config.get('CONTENT_CHUNK_SIZE', 65536)
+        return Response(
+            content.iter_bytes(start, stop, chunk_size), status=status,
+            mimetype=mimetype, headers=headers, direct_passthrough=True
+        )
 
 
 class ModelMethod(BaseResource):
@@ -234,12 +747,22 @@ class ModelMethod(BaseResource):
             :return: Response with the result of the method execution
             :rtype: Response
         """
-        method = getattr(get_model(model), method)
+        model = get_model(model)
+        method = getattr(model, method)
         data = request.json
+        ids = None
         if data and 'args' in data:
             res = method(*data['args'])
+            ids = data['args'] and data['args'][0]
         else:
             res = method()
+        # The method may write any record, the ones passed are expired too
+        if isinstance(ids, Integral):
+            ids = [ids]
+        if not (isinstance(ids, list)
+                and all(isinstance(x, Integral) for x in ids)):
+            ids = None
+        invalidate(model, ids)
         return jsonify({'res': res})
 
 
@@ -257,12 +780,85 @@ class ModelIdMethod(BaseResource):
             :return: Response with the result of the method execution
             :rtype: Response
         """
-        model = get_model(model).browse(obj_id)
-        method = getattr(model, method)
+        model = get_model(model)
+        method = getattr(model.browse(obj_id), method)
         data = request.json
         if data and 'args' in data:
             res = method(*data['args'])
         else:
             res = method()
+        invalidate(model, [obj_id])
         return jsonify({'res': res})
 
+
+class Batch(BaseResource):
+    def post(self):
+        """
+            Run many requests in one call
+
+            Consecutive GET requests run at the same time, the others one
+            after another in the given order. With `transaction` all of them
+            run in one transaction, and if any fails nothing is written.
+
+            :return: Response with the status and body of every request
+            :rtype: Response
+        """
+        data = request.json
+        if isinstance(data, list):
+            data = {'requests': data}
+        if not isinstance(data, dict):
+            data = {}
+        subs = data.get('requests')
+        max_requests = current_app.config.get('BATCH_MAX_REQUESTS', 50)
+        if (not isinstance(subs, list) or len(subs) > max_requests
+                or not all(isinstance(x, dict) for x in subs)):
+            response = jsonify({
+                'status': 'ERROR',
+                'errors': {'requests': 'A list of up to {} requests'.format(
+                    max_requests
+                )}
+            })
+            response.status_code = 400
+            return response
+        app = current_app._get_current_object()
+        user = login.current_user._get_current_object()
+        base = request.path[:-len('batch')]
+        if data.get('transaction'):
+            return self.transaction(app, user, base, subs)
+        results = []
+        reads = []
+        for sub in subs + [None]:
+            if sub is not None and sub.get('method', 'GET').upper() == 'GET':
+                reads.append(sub)
+                continue
+            if reads:
+                results += dispatch_reads(app, user, base, reads)
+                reads = []
+            if sub is not None:
+                results.append(dispatch(app, user, base, sub))
+        return jsonify({'status': 'OK', 'results': results})
+
+    @staticmethod
+    def transaction(app, user, base, subs):
+        results = []
+        with WSTransaction() as transaction:
+            for sub in subs:
+                if transaction.errors:
+                    results.append({'status': 424, 'body': None})
+                    continue
+                res = dispatch(app, user, base, sub)
+                if res['status'] >= 400:
+                    transaction.errors.append(res)
+                results.append(res)
+        if transaction.errors:
+            for res in results:
+                if res['status'] < 400:
+                    res['status'] = 424
+                    res['body'] = None
+        response = jsonify({
+            'status': 'ERROR' if transaction.errors else 'OK',
+            'results': results
+        })
+        if transaction.errors:
+            response.status_code = 422
+        return response
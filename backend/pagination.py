@@ -0,0 +1,116 @@
+from itsdangerous import URLSafeSerializer, BadData
+
+
+class CursorError(ValueError):
+    pass
+
+
+def parse_order(order, fields):
+    """Parse a sql sort criteria into a list of (field, ascending).
+
+    The id is always added as the last criteria, so the order is total.
+    """
+    res = []
+    for criteria in (order or '').split(','):
+        criteria = criteria.strip().split()
+        if not criteria:
+            continue
+        field = criteria[0]
+        direction = criteria[1].lower() if len(criteria) > 1 else 'asc'
+        if len(criteria) > 2 or direction not in ('asc', 'desc'):
+            raise CursorError('Invalid order: {}'.format(order))
+        if field != 'id':
+            attrs = fields.get(field)
+            if attrs is None or 'relation' in attrs:
+                raise CursorError(
+                    'Can not paginate by field {}'.format(field)
+                )
+        res.append((field, direction == 'asc'))
+        if field == 'id':
+            break
+    if not res or res[-1][0] != 'id':
+        res.append(('id', True))
+    return res
+
+
+def format_order(order):
+    return ', '.join(
+        '{} {}'.format(field, 'asc' if asc else 'desc') for field, asc in order
+    )
+
+
+def domain_and(*domains):
+    domains = [x for x in domains if x]
+    res = ['&'] * (len(domains) - 1)
+    for domain in domains:
+        res += domain
+    return res
+
+
+def domain_or(*domains):
+    domains = [x for x in domains if x]
+    res = ['|'] * (len(domains) - 1)
+    for domain in domains:
+        res += domain
+    return res
+
+
+def after_domain(field, asc, value, field_type):
+    """Domain for the values sorted after `value`, NULLs go last in asc."""
+    if field_type == 'boolean':
+        if asc:
+            return [] if value else [(field, '=', True)]
+        return [(field, '=', False)] if value else []
+    if value is False or value is None:
+        return [] if asc else [(field, '!=', False)]
+    if asc:
+        if field == 'id':
+            return [(field, '>', value)]
+        return domain_or([(field, '>', value)], [(field, '=', False)])
+    return [(field, '<', value)]
+
+
+def keyset_domain(order, values, fields):
+    """Domain for the records that follow `values` in `order`."""
+    clauses = []
+    for i, (field, asc) in enumerate(order):
+        field_type = fields.get(field, {}).get('type')
+        after = after_domain(field, asc, values[field], field_type)
+        if not after:
+            continue
+        equal = [
+            [(f, '=', values[f])] for f, _ in order[:i]
+        ]
+        clauses.append(domain_and(*(equal + [after])))
+    return domain_or(*clauses) or [('id', '=', 0)]
+
+
+class Cursor(object):
+    """Opaque token with the sort values of the last record of a page."""
+
+    SALT = 'backend-cursor'
+
+    def __init__(self, secret, order, fields):
+        self.serializer = URLSafeSerializer(secret, salt=self.SALT)
+        self.fields = fields
+        self.order = parse_order(order, fields)
+
+    @property
+    def sort_fields(self):
+        return [field for field, _ in self.order]
+
+    def dumps(self, record):
+        values = [record[field] for field in self.sort_fields]
+        return self.serializer.dumps([format_order(self.order), values])
+
+    def domain(self, token):
+        if not token:
+            return []
+        try:
+            order, values = self.serializer.loads(token)
+        except (BadData, ValueError, TypeError):
+            raise CursorError('Invalid cursor')
+        if order != format_order(self.order):
+            raise CursorError('Cursor was created with another order')
+        values = dict(zip(self.sort_fields, values))
+        return keyset_domain(self.order, values, self.fields)
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import threading
+
+from flask import current_app
+
+from backend.metadata import metadata
+from backend.utils import ReadPlan, get_fields, unflatdot
+
+
+def lazy_fields(model, schema):
+    """Binary and LAZY_FIELDS fields, sent as URLs without a schema."""
+    if schema:
+        return []
+    lazy = current_app.config.get('LAZY_FIELDS', {}).get(model._name, [])
+    return [
+        k for k, v in get_fields(model).items()
+        if v['type'] == 'binary' or k in lazy
+    ]
+
+
+def parse_schema(model, schema):
+    if schema:
+        return [x.strip() for x in schema.split(',')]
+    lazy = lazy_fields(model, schema)
+    return [x for x in get_fields(model) if x not in lazy]
+
+
+def compile_plan(model, schema):
+    """:class:`ReadPlan` of the `schema` argument of a request."""
+    fields = parse_schema(model, schema)
+    return ReadPlan(
+        model, unflatdot(fields), lazy_fields(model, schema), fields
+    )
+
+
+class PlanCache(object):
+    """LRU of the read plans of the schemas asked to every model.
+
+    Plans are keyed by the metadata version, the database, the model and
+    the raw schema string, so identical requests skip parsing the schema
+    and looking up the metadata of the model and its relations.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+        self._counters = {'hits': 0, 'misses': 0}
+
+    def configure(self, config):
+        """Read the cache settings from a Flask config mapping."""
+        self.max_size = config.get('PLAN_CACHE_SIZE', self.max_size)
+
+    @staticmethod
+    def calculate_key(model, schema):
+        client = model.client
+        return (
+            metadata.version(client), client._db, model._name, schema or ''
+        )
+
+    def get(self, model, schema):
+        key = self.calculate_key(model, schema)
+        with self._lock:
+            plan = self._plans.pop(key, None)
+            if plan is not None:
+                self._plans[key] = plan
+                self._counters['hits'] += 1
+                return plan
+            self._counters['misses'] += 1
+        plan = compile_plan(model, schema)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['items'] = len(self._plans)
+        return stats
+
+
+plans = PlanCache()
@@ -1,5 +1,6 @@
 from hashlib import sha1
 from time import time
+import threading
 try:
         # Due: https://www.python.org/dev/peps/pep-0476
     import ssl
@@ -15,9 +16,271 @@ except ImportError:
         pass
 
 from erppeek_wst import ClientWST as Client
+import six
+
+from backend.metrics import instrument
+from backend.upstreams import balancer as default_balancer, NETWORK_ERRORS
+from backend.admission import limiter
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class PoolEntry(object):
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.created = time()
+        self.last_used = self.created
+        self.last_check = self.created
+
 
 class Pool(object):
+    """Pool of logged in ERP clients.
+
+    Clients are keyed by (server, db, user, password hash) and are checked
+    out with :meth:`connect` and given back with :meth:`release`, so a client
+    is never used by two requests at the same time. With a list of servers
+    the `balancer` chooses the server of every checkout. The pool only
+    relies on :mod:`threading` primitives, which are patched when running
+    under gevent.
+    """
+
+    def __init__(self, max_size=50, max_per_user=10, idle_timeout=300,
+                 max_age=3600, health_check_interval=60, timeout=30,
+                 client_factory=Client, balancer=None):
+        self.max_size = max_size
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.client_factory = client_factory
+        if balancer is None:
+            balancer = default_balancer
+        self.balancer = balancer
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._idle = {}
+        self._busy = {}
+        self._size = 0
+        self._user_size = {}
+        self._counters = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'discarded': 0,
+            'failed_checks': 0,
+            'timeouts': 0,
+        }
+
+    def configure(self, config):
+        """Read the pool settings from a Flask config mapping."""
+        self.max_size = config.get('POOL_MAX_SIZE', self.max_size)
+        self.max_per_user = config.get('POOL_MAX_PER_USER', self.max_per_user)
+        self.idle_timeout = config.get('POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.max_age = config.get('POOL_MAX_AGE', self.max_age)
+        self.health_check_interval = config.get(
+            'POOL_HEALTH_CHECK_INTERVAL', self.health_check_interval
+        )
+        self.timeout = config.get('POOL_TIMEOUT', self.timeout)
+
+    @staticmethod
+    def calculate_key(server, db, user, password):
+        password = sha1((password or '').encode('utf-8')).hexdigest()
+        return server, db, user, password
+
+    def connect(self, server, db=None, user=None, password=None,
+                timeout=None):
+        """Check out a client of `user`.
+
+        `server` is an URL or a list of them, then servers that can't be
+        reached are skipped until one of them works.
+        """
+        tried = []
+        while True:
+            url = self.balancer.choose(server, exclude=tried)
+            try:
+                return self._connect(url, db, user, password, timeout)
+            except NETWORK_ERRORS:
+                tried.append(url)
+                if isinstance(server, six.string_types) or \
+                        len(tried) >= len(server):
+                    raise
+
+    def _connect(self, server, db=None, user=None, password=None,
+                 timeout=None):
+        key = self.calculate_key(server, db, user, password)
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time() + timeout
+        with self._lock:
+            while True:
+                self._evict_expired()
+                entry = self._pop_idle(key)
+                if entry is not None:
+                    self._counters['hits'] += 1
+                    break
+                if self._reserve(user):
+                    self._counters['misses'] += 1
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolExhausted(
+                        'No ERP connection available for {}'.format(user)
+                    )
+                self._available.wait(remaining)
+        if entry is None:
+            try:
+                client = self.client_factory(
+                    server, db=db, user=user, password=password
+                )
+            except Exception as e:
+                with self._lock:
+                    self._unreserve(user)
+                if isinstance(e, NETWORK_ERRORS):
+                    self.balancer.failed(server)
+                raise
+            client = limiter.limit(self.balancer.track(client, server), user)
+            entry = PoolEntry(key, instrument(client))
+        elif not self._check(entry):
+            self._discard(entry)
+            return self._connect(
+                server, db=db, user=user, password=password, timeout=timeout
+            )
+        entry.last_used = time()
+        with self._lock:
+            self._busy[id(entry.client)] = entry
+        self.balancer.acquire(server)
+        return entry.client
+
+    def server(self, client):
+        """URL of the server of the checked out `client`."""
+        with self._lock:
+            entry = self._busy.get(id(client))
+        return entry and entry.key[0]
+
+    def release(self, client):
+        with self._lock:
+            entry = self._busy.pop(id(client), None)
+            if entry is None:
+                return
+            self.balancer.release(entry.key[0])
+            now = time()
+            expired = now - entry.created > self.max_age
+            if expired or getattr(client, 'transaction_id', None):
+                self._counters['discarded'] += 1
+                self._unreserve(entry.key[2])
+            else:
+                entry.last_used = now
+                self._idle.setdefault(entry.key, []).append(entry)
+            self._available.notify()
+
+    def discard(self, client):
+        """Drop a checked out client that must not be reused."""
+        with self._lock:
+            entry = self._busy.pop(id(client), None)
+        if entry is not None:
+            self.balancer.release(entry.key[0])
+            self._discard(entry)
+
+    def clear(self):
+        with self._lock:
+            for entries in self._idle.values():
+                for entry in entries:
+                    self._unreserve(entry.key[2])
+                    self._counters['evictions'] += 1
+            self._idle = {}
+            self._available.notify_all()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['size'] = self._size
+            stats['busy'] = len(self._busy)
+            stats['idle'] = sum(len(x) for x in self._idle.values())
+        return stats
+
+    def _check(self, entry):
+        if time() - entry.last_check < self.health_check_interval:
+            return True
+        try:
+            entry.client.db.server_version()
+        except Exception as e:
+            with self._lock:
+                self._counters['failed_checks'] += 1
+            if isinstance(e, NETWORK_ERRORS):
+                self.balancer.failed(entry.key[0])
+            return False
+        entry.last_check = time()
+        return True
+
+    def _discard(self, entry):
+        with self._lock:
+            self._counters['discarded'] += 1
+            self._unreserve(entry.key[2])
+            self._available.notify()
+
+    def _pop_idle(self, key):
+        entries = self._idle.get(key)
+        if not entries:
+            return None
+        entry = entries.pop()
+        if not entries:
+            del self._idle[key]
+        return entry
+
+    def _reserve(self, user):
+        if self._user_size.get(user, 0) >= self.max_per_user:
+            if not self._evict_lru(user):
+                return False
+        if self._size >= self.max_size:
+            if not self._evict_lru():
+                return False
+        self._size += 1
+        self._user_size[user] = self._user_size.get(user, 0) + 1
+        return True
+
+    def _unreserve(self, user):
+        self._size -= 1
+        self._user_size[user] -= 1
+        if not self._user_size[user]:
+            del self._user_size[user]
+
+    def _evict_lru(self, user=None):
+        lru = None
+        for key, entries in self._idle.items():
+            if user is not None and key[2] != user:
+                continue
+            if lru is None or entries[0].last_used < lru.last_used:
+                lru = entries[0]
+        if lru is None:
+            return False
+        self._idle[lru.key].remove(lru)
+        if not self._idle[lru.key]:
+            del self._idle[lru.key]
+        self._unreserve(lru.key[2])
+        self._counters['evictions'] += 1
+        return True
+
+    def _evict_expired(self):
+        now = time()
+        for key in list(self._idle):
+            alive = []
+            for entry in self._idle[key]:
+                if (now - entry.last_used > self.idle_timeout
+                        or now - entry.created > self.max_age):
+                    self._unreserve(key[2])
+                    self._counters['evictions'] += 1
+                else:
+                    alive.append(entry)
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+
 
-    def connect(self, server, db=None, user=None, password=None):
-        client = Client(server, db=db, user=user, password=password)
-        return client
+pool = Pool()
@@ -0,0 +1,174 @@
+from collections import Counter
+from functools import wraps
+from hashlib import sha1
+from time import time, sleep, strftime
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+
+from flask import current_app, request, Response
+from six.moves import StringIO
+
+_slots = threading.Lock()
+_running = [0]
+
+
+class Sampler(object):
+    """Sample the stack of a thread every `interval` seconds.
+
+    The result is in the collapsed stack format of flame graph tools.
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def enable(self):
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+            sleep(self.interval)
+
+    def dump(self):
+        return ''.join(
+            '{} {}\n'.format(stack, n)
+            for stack, n in self.stacks.most_common()
+        )
+
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}'.format(
+            os.path.basename(code.co_filename), code.co_name
+        ))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    """cProfile with the same interface as :class:`Sampler`."""
+
+    def __init__(self, limit=50):
+        self.limit = limit
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def dump(self):
+        stream = StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        return stream.getvalue()
+
+    def save(self, path):
+        self.profile.dump_stats(path)
+
+
+def make_profiler(config, mode):
+    if mode == 'sample':
+        return Sampler(config.get('PROFILE_INTERVAL', 0.005))
+    return Profiler(config.get('PROFILE_LIMIT', 50))
+
+
+def wants_profile(config):
+    """True when the request asks for a profile and one can run now.
+
+    Requests need the ``X-Profile`` header with ``PROFILE_SECRET``. Only
+    ``PROFILE_RATE`` of them are profiled, and at most
+    ``PROFILE_MAX_CONCURRENT`` at the same time.
+    """
+    secret = config.get('PROFILE_SECRET')
+    header = request.headers.get('X-Profile')
+    if not secret or not header:
+        return False
+    if not hmac.compare_digest(header.encode('utf-8'), secret.encode('utf-8')):
+        return False
+    if random.random() >= config.get('PROFILE_RATE', 1.0):
+        return False
+    with _slots:
+        if _running[0] >= config.get('PROFILE_MAX_CONCURRENT', 1):
+            return False
+        _running[0] += 1
+    return True
+
+
+def save(config, profiler, tags):
+    """Save the profile in PROFILE_DIR with its tags, return its name."""
+    key = sha1(json.dumps(tags, sort_keys=True).encode('utf-8')).hexdigest()
+    name = '{}-{}-{}'.format(
+        strftime('%Y%m%d%H%M%S'), tags['model'] or tags['endpoint'], key[:8]
+    )
+    base = os.path.join(config['PROFILE_DIR'], name)
+    if isinstance(profiler, Profiler):
+        profiler.save(base + '.pstats')
+    else:
+        with open(base + '.collapsed', 'w') as f:
+            f.write(profiler.dump())
+    with open(base + '.json', 'w') as f:
+        json.dump(tags, f, sort_keys=True, indent=2)
+    return name
+
+
+def profiled(func):
+    """Profile the resource method when the request asks for it.
+
+    The profile replaces the response, or with ``PROFILE_DIR`` is saved there
+    and named in the ``X-Profile-File`` header.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        config = current_app.config
+        if not wants_profile(config):
+            return func(*args, **kwargs)
+        mode = request.headers.get(
+            'X-Profile-Mode', config.get('PROFILE_MODE', 'cprofile')
+        )
+        profiler = make_profiler(config, mode)
+        start = time()
+        profiler.enable()
+        try:
+            response = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with _slots:
+                _running[0] -= 1
+        tags = {
+            'endpoint': request.endpoint,
+            'method': request.method,
+            'model': kwargs.get('model'),
+            'schema': request.args.get('schema'),
+            'filter': request.args.get('filter'),
+            'duration': time() - start,
+        }
+        if config.get('PROFILE_DIR'):
+            response = current_app.make_response(response)
+            response.headers['X-Profile-File'] = save(config, profiler, tags)
+            return response
+        return Response(profiler.dump(), mimetype='text/plain')
+    return wrapper
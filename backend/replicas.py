@@ -0,0 +1,222 @@
+from datetime import datetime
+from time import sleep
+import logging
+import threading
+
+import six
+
+from backend.cache import cache
+from backend.metrics import format_labels, render_gauges
+from backend.pool import pool as default_pool
+from backend.upstreams import balancer, NETWORK_ERRORS
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+logger = logging.getLogger(__name__)
+
+
+def write_date(client, model):
+    """Last ``write_date`` of the records of `model`."""
+    model = client.model(model)
+    ids = model.search([], limit=1, order='write_date desc')
+    if not ids:
+        return None
+    value = model.read(ids, ['write_date'])[0]['write_date']
+    return value and datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+
+
+class ReplicaRouter(object):
+    """Send reads to the read only replicas of ``OPENERP_REPLICAS``.
+
+    Requests with a read method connect to a replica and the rest to
+    ``OPENERP_SERVER``. After writing, the reads of the user go to the
+    primary for ``REPLICA_STICKY_TIME`` seconds, so the user reads its
+    writes. Replicas that can't be reached, ejected by the balancer or
+    behind the primary more than ``REPLICA_MAX_LAG`` seconds are skipped,
+    and without replicas the reads go to the primary.
+    """
+
+    def __init__(self, sticky_time=10, max_lag=30, lag_interval=10,
+                 pool=None):
+        self.replicas = []
+        self.sticky_time = sticky_time
+        self.max_lag = max_lag
+        self.lag_interval = lag_interval
+        if pool is None:
+            pool = default_pool
+        self.pool = pool
+        self.lags = {}
+        self._lock = threading.Lock()
+        self._checker = None
+        self._counters = {
+            'replica_reads': 0,
+            'primary_reads': 0,
+            'fallbacks': 0,
+            'writes': 0,
+        }
+
+    def configure(self, config):
+        """Read the replicas settings from a Flask config mapping."""
+        replicas = config.get('OPENERP_REPLICAS') or []
+        if isinstance(replicas, six.string_types):
+            replicas = [replicas]
+        self.replicas = list(replicas)
+        self.sticky_time = config.get('REPLICA_STICKY_TIME', self.sticky_time)
+        self.max_lag = config.get('REPLICA_MAX_LAG', self.max_lag)
+        self.lag_interval = config.get(
+            'REPLICA_LAG_INTERVAL', self.lag_interval
+        )
+        if config.get('REPLICA_LAG_MODEL'):
+            missing = [
+                x for x in ('REPLICA_CHECK_USER', 'REPLICA_CHECK_PASSWORD')
+                if not config.get(x)
+            ]
+            if missing:
+                raise ValueError('REPLICA_LAG_MODEL needs {}'.format(
+                    ' and '.join(missing)
+                ))
+        if (self.replicas and config.get('REPLICA_LAG_MODEL')
+                and self.lag_interval and self._checker is None):
+            self._checker = threading.Thread(
+                target=self.run_lag_checks, args=(config, )
+            )
+            self._checker.daemon = True
+            self._checker.start()
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    @staticmethod
+    def sticky_key(db, user):
+        return 'replica-sticky-{}-{}'.format(db, user)
+
+    def wrote(self, db, user):
+        """Read from the primary for a while, in every worker sharing cache.
+        """
+        self._count('writes')
+        if self.replicas and self.sticky_time:
+            cache.backend.set(
+                self.sticky_key(db, user), True, self.sticky_time
+            )
+
+    def is_sticky(self, db, user):
+        return bool(cache.backend.get(self.sticky_key(db, user)))
+
+    def is_replica(self, client):
+        """True when the checked out `client` reads from a replica."""
+        if not self.replicas:
+            return False
+        return self.pool.server(client) in self.replicas
+
+    def usable(self):
+        """Replicas that can be read now."""
+        with self._lock:
+            lags = dict(self.lags)
+        return [
+            url for url in self.replicas
+            if balancer.get(url).available
+            and (lags.get(url) or 0) <= self.max_lag
+        ]
+
+    def connect(self, config, user, password, method='GET', timeout=None):
+        """Pooled client of `user` for a request with `method`."""
+        db = config['OPENERP_DATABASE']
+        replicas = []
+        if self.replicas and method in READ_METHODS:
+            if not self.is_sticky(db, user):
+                replicas = self.usable()
+        if replicas:
+            try:
+                client = self.pool.connect(
+                    replicas, db=db, user=user, password=password,
+                    timeout=timeout
+                )
+            except NETWORK_ERRORS:
+                self._count('fallbacks')
+            else:
+                self._count('replica_reads')
+                return client
+        if method in READ_METHODS:
+            self._count('primary_reads')
+        return self.pool.connect(
+            config['OPENERP_SERVER'], db=db, user=user, password=password,
+            timeout=timeout
+        )
+
+    def latest_write(self, config, server):
+        client = self.pool.connect(
+            server, db=config['OPENERP_DATABASE'],
+            user=config['REPLICA_CHECK_USER'],
+            password=config['REPLICA_CHECK_PASSWORD']
+        )
+        try:
+            return write_date(client, config['REPLICA_LAG_MODEL'])
+        finally:
+            self.pool.release(client)
+
+    def check_lag(self, config):
+        """Seconds every replica is behind the primary.
+
+        Compares the last ``write_date`` of ``REPLICA_LAG_MODEL``, a model
+        written often such as a heartbeat updated by a cron. Replicas that
+        can't be checked are considered lagging.
+        """
+        primary = config['OPENERP_SERVER']
+        if not isinstance(primary, six.string_types):
+            primary = balancer.choose(primary)
+        latest = self.latest_write(config, primary)
+        lags = {}
+        for url in self.replicas:
+            try:
+                replica = self.latest_write(config, url)
+            except Exception:
+                logger.exception('Checking the lag of %s failed', url)
+                lags[url] = float('inf')
+                continue
+            if latest is None or replica is None:
+                lags[url] = 0 if latest == replica else float('inf')
+            else:
+                lags[url] = max((latest - replica).total_seconds(), 0)
+        with self._lock:
+            self.lags = lags
+        return lags
+
+    def run_lag_checks(self, config):
+        while True:
+            sleep(self.lag_interval)
+            try:
+                self.check_lag(config)
+            except Exception:
+                # The lag is unknown, read from the primary
+                logger.exception('Checking the lag of the replicas failed')
+                with self._lock:
+                    self.lags = dict(
+                        (url, float('inf')) for url in self.replicas
+                    )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['usable'] = len(self.usable())
+        return stats
+
+    def render(self):
+        lines = render_gauges('backend_replicas', 'Replicas', self.stats())
+        with self._lock:
+            lags = sorted(self.lags.items())
+        if lags:
+            lines += [
+                '# HELP backend_replica_lag_seconds Replica behind primary.',
+                '# TYPE backend_replica_lag_seconds gauge',
+            ]
+            lines += [
+                'backend_replica_lag_seconds{{{}}} {}'.format(
+                    format_labels([('upstream', url)]), lag
+                )
+                for url, lag in lags
+            ]
+        return lines
+
+
+router = ReplicaRouter()
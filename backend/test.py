@@ -1,9 +1,42 @@
 from __future__ import absolute_import
-from flask import Flask
+from flask import Flask, g
 from flask_testing import TestCase
 from __init__ import Backend
-from backend_blueprint import backend
+from backend_blueprint import backend, APIUser
+from pool import Pool
+from backend.pool import pool
+from backend.cache import cache as data_cache
+from upstreams import Balancer
+from admission import CircuitBreaker, CircuitOpen, Limiter, UserOverloaded
+from replicas import ReplicaRouter
+from auth import CredentialCache
+from metadata import MetadataCache
+from utils import (
+    normalize_many, xmany_commands, unflatdot, extra_connection
+)
+from plans import PlanCache
+from domains import DomainCache, DomainError, parse_domain
+from coalesce import SingleFlight
+from pagination import Cursor
+from cache import DataCache, LRUCache
+from encoding import Encoder, dumps_json
+from compression import compress_response
+from metrics import Histogram, RequestStats
+from profiling import Sampler
+from content import Base64Content
 from osconf import config_from_environment
+from six.moves.xmlrpc_client import Fault
+from werkzeug.datastructures import Accept
+from werkzeug.exceptions import GatewayTimeout
+from werkzeug.wrappers import Response
+from base64 import b64encode
+from datetime import date
+from time import time, sleep
+from decimal import Decimal
+import json
+import socket
+import threading
+import zlib
 import unittest
 
 
@@ -20,6 +53,797 @@ class BackendTest(TestCase):
     def test_token(self):
         response = self.client.get('/token')
 
+    def test_erp_unavailable(self):
+        def factory(server, db=None, user=None, password=None):
+            raise socket.error('Connection refused')
+
+        self.app.config.update(
+            OPENERP_SERVER='http://down', OPENERP_DATABASE='test'
+        )
+        client_factory = pool.client_factory
+        pool.client_factory = factory
+        headers = {
+            'Authorization': 'Basic ' + b64encode(b'a:a').decode('ascii')
+        }
+        try:
+            response = self.client.get('/token', headers=headers)
+            # Not a failed login, the next request gets a 503 again
+            again = self.client.get('/token', headers=headers)
+        finally:
+            pool.client_factory = client_factory
+        self.assertStatus(response, 503)
+        self.assertIn('Retry-After', response.headers)
+        self.assertStatus(again, 503)
+
+    def test_metrics_token(self):
+        self.assert404(self.client.get('/metrics'))
+        self.app.config['METRICS_TOKEN'] = 'scraper'
+        self.assert401(self.client.get('/metrics'))
+        response = self.client.get('/metrics', headers={
+            'Authorization': 'Bearer scraper'
+        })
+        self.assert200(response)
+        self.assertIn(b'backend_pool_size', response.data)
+
+
+class ERPTestCase(TestCase):
+    """Requests to the API with a pool of FakeERP connections."""
+
+    def create_app(self):
+        app = Flask(__name__)
+        Backend(app, '/')
+        app.config.update(
+            TESTING=True, SECRET_KEY='secret', OPENERP_SERVER='http://erp',
+            OPENERP_DATABASE='test'
+        )
+        return app
+
+    def setUp(self):
+        models = {
+            'test.bill': ({
+                'number': {'type': 'char'},
+                'note': {'type': 'text'},
+                'amount': {'type': 'float'},
+                'partner_id': {'type': 'many2one', 'relation': 'test.payer'},
+            }, dict(
+                (x, {'id': x, 'number': 'F{:05d}'.format(x), 'note': 'Paid',
+                     'amount': 10.0, 'partner_id': [1, 'A']})
+                for x in (1, 2, 3)
+            )),
+            'test.payer': ({
+                'name': {'type': 'char'},
+            }, {1: {'id': 1, 'name': 'A'}}),
+        }
+        self.clients = []
+
+        def factory(server, db=None, user=None, password=None):
+            # Connections to the same ERP, sharing its records
+            self.clients.append(FakeERP(models))
+            return self.clients[-1]
+
+        self.client_factory = pool.client_factory
+        pool.client_factory = factory
+
+    def events(self):
+        return [
+            x for client in self.clients for x in client.calls
+            if x in ('commit', 'rollback')
+        ]
+
+    def tearDown(self):
+        pool.client_factory = self.client_factory
+        pool.clear()
+
+    @property
+    def headers(self):
+        auth = b64encode(b'admin:admin').decode('ascii')
+        return {
+            'Authorization': 'Basic ' + auth,
+            'Content-Type': 'application/json'
+        }
+
+
+class BatchTest(ERPTestCase):
+    def batch(self, data):
+        return self.client.post(
+            '/batch', data=json.dumps(data), headers=self.headers
+        )
+
+    def test_parallel_reads(self):
+        response = self.batch([
+            {'path': 'test.bill/{}'.format(x), 'args': {
+                'schema': 'number'
+            }} for x in (1, 2, 99)
+        ])
+        self.assert200(response)
+        results = response.json['results']
+        self.assertEqual([x['status'] for x in results], [200, 200, 500])
+        self.assertEqual(results[1]['body']['number'], 'F00002')
+        self.assertGreater(len(self.clients), 1)
+
+    def test_transaction(self):
+        sets = data_cache.stats()['sets']
+        response = self.batch({'transaction': True, 'requests': [
+            {'method': 'PATCH', 'path': 'test.bill/1',
+             'body': {'number': 'X'}},
+            {'path': 'test.bill', 'args': {
+                'schema': 'number,partner_id.name', 'filter': "[('id', '=', 1)]"
+            }},
+        ]})
+        self.assert200(response)
+        results = response.json['results']
+        self.assertEqual([x['status'] for x in results], [200, 200])
+        self.assertEqual(results[1]['body']['items'][0]['number'], 'X')
+        self.assertEqual(results[1]['body']['n_items'], 1)
+        self.assertEqual(len(self.clients), 1)
+        self.assertEqual(self.events(), ['commit'])
+        self.assertEqual(data_cache.stats()['sets'], sets)
+
+    def test_rollback(self):
+        response = self.batch({'transaction': True, 'requests': [
+            {'method': 'PATCH', 'path': 'test.bill/1',
+             'body': {'number': 'Y'}},
+            {'path': 'test.bill/99'},
+            {'path': 'test.bill/2'},
+        ]})
+        self.assertStatus(response, 422)
+        results = response.json['results']
+        self.assertEqual([x['status'] for x in results], [424, 500, 424])
+        self.assertEqual(self.events(), ['rollback'])
+
+
+class ContentEndpointTest(ERPTestCase):
+    def test_text_field(self):
+        response = self.client.get(
+            '/test.bill/1/note/content', headers=self.headers
+        )
+        self.assert200(response)
+        self.assertEqual(response.data, b'Paid')
+
+    def test_fields_without_content(self):
+        for field in ('partner_id', 'amount', 'missing'):
+            self.assert404(self.client.get(
+                '/test.bill/1/{}/content'.format(field), headers=self.headers
+            ))
+
+
+class FakeClient(object):
+    def __init__(self, server, db=None, user=None, password=None):
+        self.user = user
+        self.transaction_id = None
+
+    def execute(self, obj, method, *params, **kwargs):
+        pass
+
+
+class PoolTest(unittest.TestCase):
+    def test_reuse_client(self):
+        pool = Pool(client_factory=FakeClient)
+        client = pool.connect('http://erp', 'db', 'admin', 'admin')
+        pool.release(client)
+        self.assertIs(pool.connect('http://erp', 'db', 'admin', 'admin'), client)
+        stats = pool.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_per_user_limit(self):
+        pool = Pool(max_per_user=1, timeout=0, client_factory=FakeClient)
+        client = pool.connect('http://erp', 'db', 'admin', 'admin')
+        pool.release(client)
+        other = pool.connect('http://erp', 'db', 'admin', 'other')
+        self.assertIsNot(other, client)
+        self.assertEqual(pool.stats()['evictions'], 1)
+
+
+class BalancerTest(unittest.TestCase):
+    def test_least_outstanding(self):
+        balancer = Balancer()
+        balancer.acquire('http://a')
+        self.assertEqual(balancer.choose(['http://a', 'http://b']), 'http://b')
+
+    def test_eject_and_reinstate(self):
+        balancer = Balancer(max_failures=2)
+        servers = ['http://a', 'http://b']
+        balancer.acquire('http://b')
+        balancer.failed('http://a')
+        self.assertEqual(balancer.choose(servers), 'http://a')
+        balancer.failed('http://a')
+        self.assertEqual(balancer.choose(servers), 'http://b')
+        self.assertEqual(balancer.stats()['http://a']['ejections'], 1)
+        balancer.reinstate('http://a')
+        self.assertEqual(balancer.choose(servers), 'http://a')
+
+    def test_pool_failover(self):
+        def factory(server, db=None, user=None, password=None):
+            if server == 'http://down':
+                raise socket.error('Connection refused')
+            return FakeClient(server, db, user, password)
+
+        balancer = Balancer()
+        balancer.acquire('http://up')
+        pool = Pool(client_factory=factory, balancer=balancer)
+        pool.connect(['http://down', 'http://up'], 'db', 'admin', 'admin')
+        self.assertEqual(balancer.stats()['http://down']['errors'], 1)
+        self.assertEqual(balancer.stats()['http://up']['outstanding'], 2)
+
+
+class AdmissionTest(unittest.TestCase):
+    def test_fair_queue(self):
+        limiter = Limiter(max_concurrent=1, timeout=5)
+        limiter.acquire('bulk')
+        order = []
+
+        def call(user):
+            limiter.acquire(user)
+            order.append(user)
+            limiter.release(user)
+
+        threads = []
+        for user in ('bulk', 'bulk', 'alice'):
+            threads.append(threading.Thread(target=call, args=(user,)))
+            threads[-1].start()
+            while limiter.stats()['queued'] < len(threads):
+                sleep(0.001)
+        limiter.release('bulk')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['alice', 'bulk', 'bulk'])
+
+    def test_user_limit(self):
+        limiter = Limiter(max_per_user=1, timeout=0.01, retry_after=3)
+        limiter.acquire('bulk')
+        with self.assertRaises(UserOverloaded) as cm:
+            limiter.acquire('bulk')
+        self.assertIn(('Retry-After', '3'), cm.exception.get_headers())
+        limiter.acquire('alice')
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(min_calls=2, open_time=0.05)
+        breaker.record(False)
+        breaker.record(True)
+        self.assertRaises(CircuitOpen, breaker.allow)
+        sleep(0.05)
+        breaker.allow()
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'closed')
+
+
+class ReplicaRouterTest(unittest.TestCase):
+    config = {
+        'OPENERP_SERVER': 'http://primary',
+        'OPENERP_REPLICAS': ['http://replica'],
+        'OPENERP_DATABASE': 'db',
+    }
+
+    def make_router(self, down=()):
+        def factory(server, db=None, user=None, password=None):
+            if server in down:
+                raise socket.error('Connection refused')
+            client = FakeClient(server, db, user, password)
+            client.server = server
+            return client
+
+        router = ReplicaRouter(
+            pool=Pool(client_factory=factory, balancer=Balancer())
+        )
+        router.configure(self.config)
+        return router
+
+    def test_read_your_writes(self):
+        router = self.make_router()
+        client = router.connect(self.config, 'reader', 'x')
+        self.assertEqual(client.server, 'http://replica')
+        client = router.connect(self.config, 'writer', 'x', 'PATCH')
+        self.assertEqual(client.server, 'http://primary')
+        router.wrote('db', 'writer')
+        client = router.connect(self.config, 'writer', 'x')
+        self.assertEqual(client.server, 'http://primary')
+
+    def test_fallback(self):
+        router = self.make_router(down=['http://replica'])
+        client = router.connect(self.config, 'reader', 'x')
+        self.assertEqual(client.server, 'http://primary')
+        self.assertEqual(router.stats()['fallbacks'], 1)
+
+    def test_lagging_replica(self):
+        router = self.make_router()
+        router.lags = {'http://replica': router.max_lag + 1}
+        client = router.connect(self.config, 'reader', 'x')
+        self.assertEqual(client.server, 'http://primary')
+
+    def test_is_replica(self):
+        router = self.make_router()
+        replica = router.connect(self.config, 'a', 'x')
+        primary = router.connect(self.config, 'a', 'x', 'POST')
+        self.assertTrue(router.is_replica(replica))
+        self.assertFalse(router.is_replica(primary))
+
+    def test_lag_check_needs_user(self):
+        router = ReplicaRouter()
+        config = dict(self.config, REPLICA_LAG_MODEL='res.request')
+        self.assertRaises(ValueError, router.configure, config)
+
+    def test_extra_connection_same_server(self):
+        app = Flask(__name__)
+        app.config.update(self.config)
+        client_factory = pool.client_factory
+        pool.client_factory = FakeClient
+        try:
+            with app.test_request_context(method='POST') as ctx:
+                ctx.user = APIUser('admin', 'admin')
+                g.backend_cnx = pool.connect('http://replica', 'db', 'admin',
+                                             'admin')
+                extra = extra_connection()
+                self.assertEqual(pool.server(extra), 'http://replica')
+                pool.release(extra)
+                pool.release(g.backend_cnx)
+        finally:
+            pool.client_factory = client_factory
+            pool.clear()
+
+
+class CredentialCacheTest(unittest.TestCase):
+    def test_cache_credentials(self):
+        cache = CredentialCache()
+        key = cache.calculate_key('Basic YWRtaW46YWRtaW4=')
+        self.assertNotIn('YWRtaW46YWRtaW4=', key)
+        cache.set(key, 'admin', 'admin')
+        self.assertEqual(cache.get(key), ('admin', 'admin'))
+
+    def test_rate_limit_failures(self):
+        cache = CredentialCache(max_failures=2)
+        source = ('10.0.0.1', 'admin')
+        cache.add_failure(cache.calculate_key('a'), source)
+        self.assertTrue(cache.is_rejected(cache.calculate_key('a')))
+        self.assertFalse(cache.is_rejected(cache.calculate_key('b'), source))
+        cache.add_failure(cache.calculate_key('b'), source)
+        self.assertTrue(cache.is_rejected(cache.calculate_key('c'), source))
+        self.assertFalse(cache.is_rejected(
+            cache.calculate_key('c'), ('10.0.0.2', 'admin')
+        ))
+
+
+class FakeModel(object):
+    def __init__(self, client, name, fields, records):
+        self.client = client
+        self._name = name
+        self.fields = fields
+        self.records = records
+
+    def fields_get(self):
+        return self.fields
+
+    def default_get(self, fields, context=None):
+        return {}
+
+    def search(self, domain, offset=0, limit=None, order=None, context=None):
+        ids = sorted(
+            res_id for res_id, values in self.records.items()
+            if all(values.get(k) == v for k, op, v in domain)
+        )
+        return ids[offset:offset + limit if limit else None]
+
+    def search_count(self, domain, context=None):
+        return len(self.search(domain))
+
+    def read(self, ids, fields=None, context=None, order=None):
+        single = isinstance(ids, int)
+        if single:
+            ids = [ids]
+        self.client.calls.append((self._name, 'read', list(ids)))
+        sleep(self.client.delay)
+        fields = list(fields or self.fields)
+        res = [
+            dict((k, self.records[x].get(k)) for k in fields + ['id'])
+            for x in ids
+        ]
+        return res[0] if single else res
+
+    def write(self, ids, vals, context=None):
+        for res_id in ids:
+            self.records[res_id].update(vals)
+        return True
+
+
+class FakeERP(object):
+    _db = 'test'
+    user = 'admin'
+    major_version = '5.0'
+    transaction_id = None
+
+    def __init__(self, models, delay=0):
+        self.calls = []
+        self.delay = delay
+        self.models = dict(
+            (name, FakeModel(self, name, fields, records))
+            for name, (fields, records) in models.items()
+        )
+
+    def model(self, name):
+        return self.models[name]
+
+    def read(self, obj, domain, fields):
+        return [{'name': 'base', 'latest_version': '5.0.1'}]
+
+    def execute(self, obj, method, *params, **kwargs):
+        pass
+
+    def begin(self):
+        self.transaction_id = 1
+        return self
+
+    def commit(self):
+        self.calls.append('commit')
+
+    def rollback(self):
+        self.calls.append('rollback')
+
+    def close(self):
+        self.transaction_id = None
+
+
+class MetadataCacheTest(unittest.TestCase):
+    def test_without_modules_access(self):
+        class RestrictedERP(FakeERP):
+            def read(self, obj, domain, fields):
+                raise Fault('AccessError', 'ir.module.module')
+
+        cache = MetadataCache()
+        version = cache.version(FakeERP({}))
+        cache._versions = {}
+        self.assertEqual(cache.version(RestrictedERP({})), version)
+
+    def test_fields_by_user(self):
+        erp = FakeERP({'test.fields': ({'name': {'type': 'char'}}, {})})
+        cache = MetadataCache()
+        model = erp.model('test.fields')
+        cache.fields_get(model)
+        other = FakeERP({'test.fields': ({
+            'name': {'type': 'char', 'readonly': True}
+        }, {})})
+        other.user = 'portal'
+        self.assertTrue(
+            cache.fields_get(other.model('test.fields'))['name']['readonly']
+        )
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_one_read_per_relation(self):
+        erp = FakeERP({
+            'test.invoice': ({
+                'number': {'type': 'char'},
+                'partner_id': {'type': 'many2one', 'relation': 'test.partner'},
+            }, {}),
+            'test.partner': ({
+                'name': {'type': 'char'},
+            }, {1: {'id': 1, 'name': 'A'}, 2: {'id': 2, 'name': 'B'}}),
+        })
+        items = [
+            {'id': x, 'number': str(x), 'partner_id': [x % 2 + 1, '']}
+            for x in range(10)
+        ]
+        result = normalize_many(
+            erp.model('test.invoice'), items, {'partner_id': {'name': True}}
+        )
+        self.assertEqual(erp.calls, [('test.partner', 'read', [1, 2])])
+        self.assertEqual(result[1]['partner_id'], {'id': 2, 'name': 'B'})
+
+    def normalize_siblings(self, suffix, delay=0, **config):
+        """Normalize an order with two relations using extra connections."""
+        models = {
+            'test.order' + suffix: ({
+                'partner_id': {
+                    'type': 'many2one', 'relation': 'test.customer' + suffix
+                },
+                'user_id': {
+                    'type': 'many2one', 'relation': 'test.user' + suffix
+                },
+            }, {}),
+            'test.customer' + suffix: ({
+                'name': {'type': 'char'},
+            }, {1: {'id': 1, 'name': 'A'}}),
+            'test.user' + suffix: ({
+                'login': {'type': 'char'},
+            }, {1: {'id': 1, 'login': 'admin'}}),
+        }
+        clients = []
+
+        def factory(server, db=None, user=None, password=None):
+            # The connection of the request is fast, the extra ones slow
+            clients.append(FakeERP(models, delay if clients else 0))
+            return clients[-1]
+
+        app = Flask(__name__)
+        Backend(app, '/')
+        app.config.update(
+            OPENERP_SERVER='http://erp', OPENERP_DATABASE='test', **config
+        )
+        client_factory = pool.client_factory
+        pool.client_factory = factory
+        try:
+            with app.test_request_context() as ctx:
+                ctx.user = APIUser('admin', 'admin')
+                g.backend_cnx = pool.connect('http://erp', 'test', 'admin',
+                                             'admin')
+                try:
+                    model = g.backend_cnx.model('test.order' + suffix)
+                    result = normalize_many(model, [
+                        {'id': 1, 'partner_id': [1, ''], 'user_id': [1, '']}
+                    ], {
+                        'partner_id': {'name': True},
+                        'user_id': {'login': True}
+                    })
+                finally:
+                    pool.release(g.backend_cnx)
+        finally:
+            pool.client_factory = client_factory
+            pool.clear()
+        return result, clients
+
+    def test_sibling_relations(self):
+        result, clients = self.normalize_siblings('.concurrent', delay=0.05)
+        self.assertEqual(len(clients), 2)
+        self.assertEqual([len(x.calls) for x in clients], [1, 1])
+        self.assertEqual(result[0]['partner_id'], {'id': 1, 'name': 'A'})
+        self.assertEqual(result[0]['user_id'], {'id': 1, 'login': 'admin'})
+
+    def test_sibling_relations_timeout(self):
+        self.assertRaises(
+            GatewayTimeout, self.normalize_siblings, '.timeout', delay=0.5,
+            NORMALIZE_TIMEOUT=0.01
+        )
+
+
+class PlanCacheTest(unittest.TestCase):
+    def test_unflatdot(self):
+        self.assertEqual(unflatdot(['b.c', 'a', 'b', 'b.d.e']), {
+            'a': True, 'b': {'c': True, 'd': {'e': True}}
+        })
+        self.assertEqual(unflatdot(['a', 'a.b']), unflatdot(['a.b', 'a']))
+
+    def test_compiled_once(self):
+        erp = FakeERP({
+            'test.ticket': ({
+                'name': {'type': 'char'},
+                'partner_id': {'type': 'many2one', 'relation': 'test.contact'},
+            }, {}),
+            'test.contact': ({
+                'name': {'type': 'char'},
+            }, {}),
+        })
+        plans = PlanCache()
+        model = erp.model('test.ticket')
+        plan = plans.get(model, 'partner_id.name, name')
+        self.assertIs(plans.get(model, 'partner_id.name, name'), plan)
+        self.assertEqual(plans.stats(), {'hits': 1, 'misses': 1, 'items': 1})
+        self.assertEqual(plan.columns, ['partner_id.name', 'name'])
+        self.assertEqual(plan.children['partner_id'].fields, ['name'])
+        self.assertFalse(plan.fingerprint)
+
+
+class DomainTest(unittest.TestCase):
+    def test_parse(self):
+        domain = parse_domain(
+            "['|', ('id', 'IN', (3, 1, 3)), 'name = foo', ('a', '=', 1)]"
+        )
+        self.assertEqual(domain, [
+            '|', ('id', 'in', [1, 3]), ('name', '=', 'foo'), ('a', '=', 1)
+        ])
+
+    def test_invalid(self):
+        for filter_ in ("['&', ('a', '=', 1)]", "[('a', 'is', 1)]",
+                        "[('a', '=', [1])]", "[('a', 'in', [0] * 5)]",
+                        "__import__('os')", "[('a', '=', 1)] * 2"):
+            self.assertRaises(
+                DomainError, parse_domain, filter_, max_values=4
+            )
+
+    def test_check_fields(self):
+        erp = FakeERP({
+            'test.visit': ({
+                'partner_id': {'type': 'many2one', 'relation': 'test.host'},
+            }, {}),
+            'test.host': ({
+                'name': {'type': 'char'},
+            }, {}),
+        })
+        domains = DomainCache()
+        model = erp.model('test.visit')
+        self.assertEqual(
+            domains.get(model, "[('partner_id.name', '=', 'A')]"),
+            [('partner_id.name', '=', 'A')]
+        )
+        self.assertRaises(
+            DomainError, domains.get, model, "[('partner_id.vat', '=', 'A')]"
+        )
+
+    def test_relation_without_access(self):
+        erp = FakeERP({
+            'test.call': ({
+                'partner_id': {'type': 'many2one', 'relation': 'test.secret'},
+            }, {}),
+            'test.secret': ({}, {}),
+        })
+
+        def fields_get():
+            raise Fault('AccessError', 'test.secret')
+        erp.model('test.secret').fields_get = fields_get
+        self.assertRaises(
+            DomainError, DomainCache().get, erp.model('test.call'),
+            "[('partner_id.name', '=', 'A')]"
+        )
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_shared_call(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def read():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return [{'id': 1}]
+
+        def caller():
+            results.append(flights.do('key', read))
+
+        threads = [threading.Thread(target=caller) for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while flights.stats()['shared'] < 2:
+            sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [[{'id': 1}]] * 3)
+        self.assertIsNot(results[1], results[2])
+        self.assertEqual(flights.stats()['in_flight'], 0)
+
+    def test_key(self):
+        erp = FakeERP({'test.flight': ({}, {})})
+        model = erp.model('test.flight')
+        erp._server = 'http://primary/xmlrpc'
+        key = SingleFlight.calculate_key(model, 'read', (1, ), {})
+        erp._server = 'http://replica/xmlrpc'
+        self.assertNotEqual(
+            SingleFlight.calculate_key(model, 'read', (1, ), {}), key
+        )
+
+    def test_transaction_not_shared(self):
+        erp = FakeERP({'test.flight': ({}, {})})
+        erp.transaction_id = 1
+        flights = SingleFlight()
+        flights.call(erp.model('test.flight'), 'fields_get')
+        self.assertEqual(flights.stats()['calls'], 0)
+
+
+class RecursiveCrudTest(unittest.TestCase):
+    def test_xmany_commands(self):
+        erp = FakeERP({
+            'test.line': ({
+                'name': {'type': 'char'},
+            }, {1: {'id': 1, 'name': 'A'}, 2: {'id': 2, 'name': 'B'}}),
+        })
+        commands = xmany_commands(erp.model('test.line'), [
+            {'name': 'C'}, {'id': 1, 'name': 'A'}, {'id': 2, 'name': 'D'}, 3
+        ])
+        self.assertEqual(commands, [
+            (0, 0, {'name': 'C'}), (4, 1), (1, 2, {'name': 'D'}), (4, 2), (4, 3)
+        ])
+        self.assertEqual(erp.calls, [('test.line', 'read', [1, 2])])
+
+
+class DataCacheTest(unittest.TestCase):
+    def test_lru_max_bytes(self):
+        lru = LRUCache(max_bytes=200)
+        for x in range(10):
+            lru.set(x, 'x' * 50)
+        self.assertLessEqual(lru.bytes, 200)
+        self.assertIsNone(lru.get(0))
+        self.assertEqual(lru.get(9), 'x' * 50)
+
+    def test_invalidate(self):
+        cache = DataCache()
+        cache.set_many_data('res.partner', [{'id': 1, 'name': 'A'}], ['name'])
+        found = cache.get_many_data('res.partner', [1, 2], ['name'])
+        self.assertEqual(found, {1: {'id': 1, 'name': 'A'}})
+        cache.invalidate('res.partner', [1])
+        self.assertEqual(cache.get_many_data('res.partner', [1], ['name']), {})
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_count_by_user(self):
+        cache = DataCache()
+        cache.set_count('res.partner', [], 'admin', 10)
+        self.assertEqual(cache.get_count('res.partner', [], 'admin'), 10)
+        self.assertIsNone(cache.get_count('res.partner', [], 'portal'))
+
+
+class CursorTest(unittest.TestCase):
+    def test_keyset_domain(self):
+        fields = {'name': {'type': 'char'}}
+        cursor = Cursor('secret', 'name desc', fields)
+        token = cursor.dumps({'id': 4, 'name': 'B'})
+        self.assertEqual(cursor.domain(token), [
+            '|', ('name', '<', 'B'), '&', ('name', '=', 'B'), ('id', '>', 4)
+        ])
+        other = Cursor('secret', 'name asc', fields)
+        self.assertRaises(ValueError, other.domain, token)
+
+
+class EncodingTest(unittest.TestCase):
+    def test_erp_types(self):
+        values = {'date': date(2020, 1, 31), 'amount': Decimal('1.5')}
+        expected = {'date': '2020-01-31', 'amount': 1.5}
+        self.assertEqual(json.loads(dumps_json(values)), expected)
+        encoded = Encoder().dumps(values)
+        self.assertEqual(json.loads(encoded.decode('utf-8')), expected)
+
+    def test_compress_response(self):
+        data = b'{"items": []}' * 100
+        response = Response(data, mimetype='application/json')
+        response.set_etag('abc')
+        compress_response(response, Accept([('gzip', 1)]), {})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.get_etag(), ('abc', True))
+        self.assertEqual(zlib.decompress(response.get_data(), 31), data)
+        small = Response(b'{}', mimetype='application/json')
+        compress_response(small, Accept([('gzip', 1)]), {})
+        self.assertNotIn('Content-Encoding', small.headers)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self):
+        histogram = Histogram('calls', 'Calls.', ('method',), (1, 5))
+        for value in (0, 3, 10):
+            histogram.observe(value, 'read')
+        lines = histogram.render()
+        self.assertIn('calls_bucket{method="read",le="1"} 1', lines)
+        self.assertIn('calls_bucket{method="read",le="5"} 2', lines)
+        self.assertIn('calls_bucket{method="read",le="+Inf"} 3', lines)
+        self.assertIn('calls_count{method="read"} 3', lines)
+
+    def test_server_timing(self):
+        stats = RequestStats('test')
+        stats.record('res.partner', 'read', 0.01)
+        stats.record('res.partner', 'read', 0.02)
+        stats.add_timing('normalize', 0.05)
+        timing = stats.server_timing()
+        self.assertTrue(timing.startswith(
+            'rpc-read;dur=30.0;desc="2 calls", normalize;dur=50.0, total;dur='
+        ))
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_sampler(self):
+        def busy():
+            start = time()
+            while time() - start < 0.05:
+                pass
+        sampler = Sampler(interval=0.001)
+        sampler.enable()
+        busy()
+        sampler.disable()
+        self.assertIn('test.py:busy', sampler.dump())
+
+
+class ContentTest(unittest.TestCase):
+    def test_base64_ranges(self):
+        data = bytes(bytearray(range(256))) * 10
+        content = Base64Content(b64encode(data))
+        self.assertEqual(len(content), len(data))
+        for start, stop in ((0, len(data)), (1, 2), (5, 2000), (2558, 2560)):
+            self.assertEqual(
+                b''.join(content.iter_bytes(start, stop, chunk_size=100)),
+                data[start:stop]
+            )
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,280 @@
+from collections import OrderedDict
+from random import random
+from time import time, sleep
+import socket
+import threading
+
+import six
+from six.moves import http_client
+from six.moves.xmlrpc_client import (
+    ProtocolError, SafeTransport, ServerProxy, Transport
+)
+
+from backend.metrics import format_labels
+
+# Errors meaning the server didn't answer, Faults are answers
+NETWORK_ERRORS = (socket.error, ProtocolError, http_client.HTTPException)
+
+
+class TimeoutTransport(Transport):
+
+    def __init__(self, timeout, *args, **kwargs):
+        Transport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class SafeTimeoutTransport(SafeTransport):
+
+    def __init__(self, timeout, *args, **kwargs):
+        SafeTransport.__init__(self, *args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = SafeTransport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+def server_version(url, timeout=5):
+    """``server_version`` of the ERP at `url` waiting at most `timeout`."""
+    if '/xmlrpc' not in url:
+        url += '/xmlrpc'
+    if url.startswith('https'):
+        transport = SafeTimeoutTransport(timeout)
+    else:
+        transport = TimeoutTransport(timeout)
+    return ServerProxy(url + '/db', transport=transport).server_version()
+
+
+class Upstream(object):
+    """An ERP server with its load and health."""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0
+        self.counters = {
+            'connections': 0,
+            'calls': 0,
+            'errors': 0,
+            'ejections': 0,
+        }
+
+    @property
+    def available(self):
+        return self.ejected_until <= time()
+
+
+class Balancer(object):
+    """Choose the ERP server of every pooled connection.
+
+    ``OPENERP_SERVER`` can be a list of servers. New connections go to the
+    available server with the least requests using it
+    (``least_outstanding``) or with the lowest latency times those requests
+    (``latency``). A server failing ``UPSTREAM_MAX_FAILURES`` times in a row,
+    in calls or in the checks made every ``UPSTREAM_CHECK_INTERVAL``
+    seconds, is ejected for ``UPSTREAM_EJECT_TIME`` seconds. The time doubles
+    every time it is ejected again, up to ``UPSTREAM_MAX_EJECT_TIME``, and a
+    successful check reinstates it. When all the servers are ejected the
+    first one to come back is used. The ``OPENERP_REPLICAS`` are checked
+    too.
+    """
+
+    def __init__(self, policy='least_outstanding', max_failures=3,
+                 eject_time=10, max_eject_time=300, check_interval=10,
+                 check_timeout=5):
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_eject_time = max_eject_time
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self._lock = threading.Lock()
+        self._upstreams = OrderedDict()
+        self._checker = None
+
+    def configure(self, config):
+        """Read the balancing settings from a Flask config mapping."""
+        self.policy = config.get('UPSTREAM_POLICY', self.policy)
+        self.max_failures = config.get(
+            'UPSTREAM_MAX_FAILURES', self.max_failures
+        )
+        self.eject_time = config.get('UPSTREAM_EJECT_TIME', self.eject_time)
+        self.max_eject_time = config.get(
+            'UPSTREAM_MAX_EJECT_TIME', self.max_eject_time
+        )
+        self.check_interval = config.get(
+            'UPSTREAM_CHECK_INTERVAL', self.check_interval
+        )
+        self.check_timeout = config.get(
+            'UPSTREAM_CHECK_TIMEOUT', self.check_timeout
+        )
+        servers = config.get('OPENERP_SERVER') or []
+        if isinstance(servers, six.string_types):
+            servers = [servers]
+        replicas = config.get('OPENERP_REPLICAS') or []
+        if isinstance(replicas, six.string_types):
+            replicas = [replicas]
+        servers = list(servers) + list(replicas)
+        if len(servers) > 1:
+            for url in servers:
+                self.get(url)
+            if self.check_interval and self._checker is None:
+                self._checker = threading.Thread(target=self.run_checks)
+                self._checker.daemon = True
+                self._checker.start()
+
+    def get(self, url):
+        with self._lock:
+            upstream = self._upstreams.get(url)
+            if upstream is None:
+                upstream = self._upstreams[url] = Upstream(url)
+        return upstream
+
+    def score(self, upstream):
+        if self.policy == 'latency':
+            load = (upstream.latency or 0) * (upstream.outstanding + 1)
+        else:
+            load = upstream.outstanding
+        # Ties are broken at random so idle servers share the load
+        return load, random()
+
+    def choose(self, servers, exclude=()):
+        """URL of the server of `servers` for a new connection."""
+        if isinstance(servers, six.string_types):
+            return servers
+        upstreams = [self.get(x) for x in servers if x not in exclude]
+        if not upstreams:
+            upstreams = [self.get(x) for x in servers]
+        available = [x for x in upstreams if x.available]
+        if not available:
+            return min(upstreams, key=lambda x: x.ejected_until).url
+        with self._lock:
+            return min(available, key=self.score).url
+
+    def acquire(self, url):
+        """A request starts using a connection to `url`."""
+        upstream = self.get(url)
+        with self._lock:
+            upstream.outstanding += 1
+            upstream.counters['connections'] += 1
+
+    def release(self, url):
+        upstream = self.get(url)
+        with self._lock:
+            upstream.outstanding -= 1
+
+    def succeeded(self, url, duration=None):
+        upstream = self.get(url)
+        with self._lock:
+            upstream.failures = 0
+            if upstream.available:
+                upstream.ejections = 0
+            if duration is not None:
+                upstream.counters['calls'] += 1
+                if upstream.latency is None:
+                    upstream.latency = duration
+                else:
+                    upstream.latency = 0.8 * upstream.latency + 0.2 * duration
+
+    def failed(self, url):
+        upstream = self.get(url)
+        now = time()
+        with self._lock:
+            upstream.counters['errors'] += 1
+            upstream.failures += 1
+            if upstream.failures < self.max_failures or not upstream.available:
+                return
+            upstream.ejected_until = now + min(
+                self.eject_time * 2 ** upstream.ejections, self.max_eject_time
+            )
+            upstream.ejections += 1
+            upstream.counters['ejections'] += 1
+
+    def reinstate(self, url):
+        upstream = self.get(url)
+        with self._lock:
+            upstream.failures = 0
+            upstream.ejections = 0
+            upstream.ejected_until = 0
+
+    def track(self, client, url):
+        """Record the latency and the failures of the calls of `client`."""
+        if getattr(client, '_tracked', False):
+            return client
+        execute = client.execute
+
+        def wrapper(obj, method, *params, **kwargs):
+            start = time()
+            try:
+                res = execute(obj, method, *params, **kwargs)
+            except NETWORK_ERRORS:
+                self.failed(url)
+                raise
+            except Exception:
+                self.succeeded(url, time() - start)
+                raise
+            self.succeeded(url, time() - start)
+            return res
+        client.execute = wrapper
+        client._tracked = True
+        return client
+
+    def check(self, url):
+        try:
+            server_version(url, self.check_timeout)
+        except Exception:
+            self.failed(url)
+            return False
+        if not self.get(url).available:
+            self.reinstate(url)
+        else:
+            self.succeeded(url)
+        return True
+
+    def run_checks(self):
+        while True:
+            sleep(self.check_interval)
+            with self._lock:
+                urls = list(self._upstreams)
+            for url in urls:
+                self.check(url)
+
+    def stats(self):
+        res = OrderedDict()
+        with self._lock:
+            for url, upstream in self._upstreams.items():
+                stats = dict(upstream.counters)
+                stats['outstanding'] = upstream.outstanding
+                stats['latency'] = upstream.latency or 0
+                stats['available'] = int(upstream.available)
+                res[url] = stats
+        return res
+
+    def render(self):
+        """Gauges of every server in the Prometheus text format."""
+        stats = self.stats()
+        keys = sorted(set(k for x in stats.values() for k in x))
+        lines = []
+        for key in keys:
+            metric = 'backend_upstream_{}'.format(key)
+            lines += [
+                '# HELP {} Upstream {}.'.format(metric, key),
+                '# TYPE {} gauge'.format(metric),
+            ]
+            for url, values in stats.items():
+                lines.append('{}{{{}}} {}'.format(
+                    metric, format_labels([('upstream', url)]), values[key]
+                ))
+        return lines
+
+
+balancer = Balancer()
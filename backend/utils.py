@@ -1,47 +1,101 @@
 import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 from numbers import Integral
-from hashlib import sha1
+import threading
 
-from werkzeug.contrib.cache import SimpleCache
-from flask import g
+from flask import g, current_app, has_app_context, has_request_context
+import flask_login as login
+from werkzeug.exceptions import GatewayTimeout
 
+from backend.metadata import metadata
+from backend.cache import cache
+from backend import metrics
+from backend.pool import pool, PoolExhausted
+from backend.coalesce import flights
+from backend.replicas import router
 
-class DataCache(SimpleCache):
 
-    TIMEOUT = 10
+LAST_UPDATE = '__last_update'
+XMANY_TYPES = ('one2many', 'many2many')
 
-    @staticmethod
-    def calculate_key(model, ids, fields):
-        if not isinstance(ids, (list, tuple)):
-            ids = [ids]
-        ids = sorted(ids)
-        fields = sorted(fields)
-        key_args = '{}-{}-{}'.format(model, ids, fields).encode('utf-8')
-        key = sha1(key_args).hexdigest()
-        return key
 
-    def get_data(self, model, ids, fields):
-        key = self.calculate_key(model, ids, fields)
-        return self.get(key)
+class Background(object):
+    """Run `func` in a thread recording its upstream calls in this request."""
 
-    def set_data(self, model, ids, fields, values):
-        key = self.calculate_key(model, ids, fields)
-        self.set(key, values, self.TIMEOUT)
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.stats = metrics.current()
+        self.res = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
 
-    def get_fields(self, model):
-        key = '{}_fields'.format(model)
-        return self.get(key)
+    def run(self):
+        metrics.bind(self.stats)
+        try:
+            self.res = self.func(*self.args, **self.kwargs)
+        except Exception as e:
+            self.error = e
+        finally:
+            metrics.bind(None)
 
-    def set_fields(self, model, fields):
-        key = '{}_fields'.format(model)
-        self.set(key, fields, self.TIMEOUT)
+    def result(self, timeout=None):
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            raise GatewayTimeout(
+                'No response from PowERP in {} seconds'.format(timeout)
+            )
+        if self.error is not None:
+            raise self.error
+        return self.res
 
 
-cache = DataCache()
+def in_transaction(client):
+    """True when `client` runs in a WS transaction not committed yet.
 
+    What it reads can be rolled back, so it is neither cached nor shared.
+    """
+    return bool(getattr(client, 'transaction_id', None))
 
-def recursive_crud(model, values):
-    schema = model.fields_get()
+
+def cacheable(client):
+    """True when what `client` reads can be cached for every user.
+
+    Not in a transaction nor reading a replica, which can be behind the
+    writes that expired the cache.
+    """
+    return not in_transaction(client) and not router.is_replica(client)
+
+
+def invalidate(model, ids=None):
+    """Forget the cached `ids` of `model`, again when its transaction ends.
+
+    Until then other requests can cache the records as they were before the
+    transaction.
+    """
+    cache.invalidate(model._name, ids)
+    transaction = has_app_context() and g.get('backend_transaction')
+    if transaction:
+        transaction.touched.append((model._name, ids))
+
+
+def is_reference(value):
+    return isinstance(value, dict) and list(value.keys()) == ['id']
+
+
+def crud_values(model, values):
+    """Values for create or write.
+
+    Nested x2many records go inline as commands, so a whole document is
+    written with one call. Nested many2one records are written first.
+    """
+    schema = get_fields(model)
     vals = {}
     for k, v in values.items():
         if k == 'id':
@@ -59,7 +113,7 @@ def recursive_crud(model, values):
             if field_type == 'many2one':
                 if isinstance(v, Integral):
                     vals[k] = v
-                elif v.keys() == ['id']:
+                elif is_reference(v):
                     vals[k] = v['id']
                 else:
                     vals[k] = recursive_crud(relation, v)
@@ -67,89 +121,374 @@ def recursive_crud(model, values):
                 if not v:
                     vals[k] = [(5, )]
                 else:
-                    xmany = []
-                    for value in v:
-                        if value.keys() == ['id']:
-                            xmany.append((4, value['id']))
-                        else:
-                            xmany.append((4, recursive_crud(relation, value)))
-                    vals[k] = xmany
+                    vals[k] = xmany_commands(relation, v)
         else:
             vals[k] = v
+    return vals
+
+
+def xmany_commands(relation, values):
+    """Commands to create, update and link the records of a x2many field.
+
+    New records are created inline with ``(0, 0, vals)`` and existing ones
+    are updated with ``(1, id, vals)``, comparing them with their stored
+    values read in a single call.
+    """
+    updates = [
+        x for x in values
+        if isinstance(x, dict) and 'id' in x and not is_reference(x)
+    ]
+    stored = {}
+    if updates:
+        fields = set()
+        for value in updates:
+            fields.update(k for k in value if k != 'id')
+        stored = dict(
+            (x['id'], x)
+            for x in relation.read([x['id'] for x in updates], list(fields))
+        )
+    commands = []
+    for value in values:
+        if isinstance(value, Integral):
+            commands.append((4, value))
+        elif is_reference(value):
+            commands.append((4, value['id']))
+        elif 'id' not in value:
+            commands.append((0, 0, crud_values(relation, value)))
+        else:
+            vals = crud_values(relation, value)
+            res_id = vals.pop('id')
+            vals = changed_values(vals, stored.get(res_id, {}))
+            if vals:
+                commands.append((1, res_id, vals))
+                invalidate(relation, [res_id])
+            commands.append((4, res_id))
+    return commands
+
+
+def changed_values(vals, stored):
+    """The values in `vals` that are not the same in `stored`."""
+    changed = {}
+    for key, value in vals.items():
+        if key in stored:
+            stored_value = stored[key]
+            if isinstance(stored_value, list) and isinstance(value, Integral):
+                stored_value = stored_value and stored_value[0]
+            if stored_value == value:
+                continue
+        changed[key] = value
+    return changed
+
 
+def recursive_crud(model, values):
+    vals = crud_values(model, values)
     if 'id' not in vals:
         item_id = model.create(vals).id
+        invalidate(model)
     else:
         item_id = vals.pop('id', None)
         if vals:
             stored = model.read([item_id], list(vals.keys()))[0]
-            stored.pop('id', None)
-            for key, stored_value in stored.items():
-                if vals[key] == stored_value:
-                    vals.pop(key)
+            vals = changed_values(vals, stored)
         if vals:
             model.write([item_id], vals)
+            invalidate(model, [item_id])
     return item_id
 
 
-def normalize(model, values, dump_schema=None, context=None):
-    if dump_schema is None:
-        dump_schema = {}
-    schema = cache.get_fields(model._name)
-    if schema is None:
-        schema = model.fields_get()
-        cache.set_fields(model._name, schema)
-    _values = values.copy()
-    for k, v in _values.items():
-        field_type = schema.get(k, {}).get('type')
-        if field_type is None:
+def is_plain(model, values):
+    """True when `values` is a new record without nested many2one records.
+
+    These records are created with a single call, their x2many records go
+    inline.
+    """
+    if 'id' in values:
+        return False
+    schema = get_fields(model)
+    for k, v in values.items():
+        if schema.get(k, {}).get('type') != 'many2one':
             continue
-        elif field_type.endswith('2many') and not v:
-            _values[k] = []
-        elif field_type != 'boolean' and not v:
-            _values[k] = None
-        elif 'relation' in schema[k]:
-            relation = model.client.model(schema[k]['relation'])
-            fields_to_read = []
-            if k in dump_schema and isinstance(dump_schema[k], dict):
-                fields_to_read = dump_schema[k]
-            if field_type == 'many2one':
-                if fields_to_read:
-                    data = cache.get_data(
-                        relation._name,
-                        _values[k][0],
-                        fields_to_read
-                    )
-                    if data is None:
-                        data = relation.read(_values[k][0], fields_to_read, context=context)
-                        cache.set_data(
-                            relation._name,
-                            _values[k][0],
-                            fields_to_read,
-                            data
-                        )
-                    _values[k] = normalize(
-                        relation, data, dump_schema.get(k), context=context
-                    )
-                else:
-                    _values[k] = {'id': values[k][0]}
-            else:
-                rel_ids = _values[k]
-                _values[k] = []
-                if fields_to_read:
-                    for data in relation.read(rel_ids, fields_to_read, context=context):
-                        _values[k].append(normalize(
-                            relation, data, dump_schema.get(k), context=context
-                        ))
+        if isinstance(v, dict) and not is_reference(v):
+            return False
+    return True
+
+
+def create_many(model, records):
+    """Create plain records, with one call when the server allows it."""
+    vals = [crud_values(model, values) for values in records]
+    if float(model.client.major_version) >= 12.0:
+        res_ids = model._execute('create', vals)
+    else:
+        res_ids = [model.create(x).id for x in vals]
+    invalidate(model)
+    return res_ids
+
+
+def is_fingerprintable(model, dump_schema):
+    """True when the dumped values only change when the records are written.
+
+    Then the ids and ``__last_update`` of the records are enough to know if
+    they changed. Expanded relations, x2many ids and not stored function
+    fields can change without writing the records.
+    """
+    fields = get_fields(model)
+    for k, v in dump_schema.items():
+        if k == 'id':
+            continue
+        attrs = fields.get(k, {})
+        if isinstance(v, dict) or attrs.get('type') in XMANY_TYPES:
+            return False
+        if attrs.get('function') and not attrs.get('store'):
+            return False
+        if attrs.get('store') is False:
+            return False
+    return True
+
+
+def get_fields(model):
+    return metadata.fields_get(model)
+
+
+class ReadPlan(object):
+    """What reading a schema of a model needs, resolved once.
+
+    Holds the tree of the schema, the fields read at this level, the
+    ``fields_get`` of the model and a plan for every expanded relation, so
+    :func:`normalize_many` doesn't parse the schema nor look up metadata.
+    `columns` are the dotted fields in the order they were asked.
+    """
+
+    def __init__(self, model, schema, lazy=(), columns=None):
+        self.model = model._name
+        self.schema = schema
+        self.fields = list(schema.keys())
+        self.fields_def = get_fields(model)
+        self.lazy = list(lazy)
+        if columns is None:
+            columns = flatdot(schema)
+        self.columns = list(columns) + self.lazy
+        self.key = (self.model, tuple(sorted(flatdot(schema))))
+        self.fingerprint = is_fingerprintable(model, schema)
+        self.children = {}
+        for k, v in schema.items():
+            relation = self.fields_def.get(k, {}).get('relation')
+            if relation and isinstance(v, dict):
+                self.children[k] = ReadPlan(model.client.model(relation), v)
+
+
+def read_plan(model, dump_schema):
+    """`dump_schema` as a :class:`ReadPlan`."""
+    if isinstance(dump_schema, ReadPlan):
+        return dump_schema
+    return ReadPlan(model, dump_schema or {})
+
+
+def read_cached(relation, ids, fields, context=None):
+    """Read `ids` from `relation` using one call for the ids not in cache."""
+    found = cache.get_many_data(relation._name, ids, fields)
+    missing = [x for x in ids if x not in found]
+    if missing:
+        records = flights.call(
+            relation, 'read', missing, fields, context=context
+        ) or []
+        if cacheable(relation.client):
+            cache.set_many_data(relation._name, records, fields)
+        for data in records:
+            found[data['id']] = data
+    return found
+
+
+def extra_connection():
+    """Another pooled connection of the current user, None if none is free.
+
+    It goes to the server of the request connection, so it reads from the
+    same primary or replica. Requests in a transaction have none, other
+    connections can't see what they wrote.
+    """
+    client = g.get('backend_cnx')
+    if client is None or in_transaction(client):
+        return None
+    server = pool.server(client)
+    if server is None:
+        return None
+    user = login.current_user
+    try:
+        return pool.connect(
+            server, db=current_app.config['OPENERP_DATABASE'],
+            user=user.login, password=user.password, timeout=0
+        )
+    except PoolExhausted:
+        return None
+
+
+def read_with(client, model, ids, fields, context=None):
+    """:func:`read_cached` with `client`, which is released afterwards."""
+    try:
+        return read_cached(client.model(model), ids, fields, context=context)
+    finally:
+        pool.release(client)
+
+
+def fetch_reads(jobs, context=None):
+    """Run the (relation, ids, fields) reads of `jobs`.
+
+    The reads are independent, so up to NORMALIZE_CONCURRENCY of them run at
+    the same time, each one with its own pooled connection. The rest, or all
+    of them without free connections, run one after another.
+    """
+    concurrency = 1
+    timeout = None
+    if has_request_context() and len(jobs) > 1:
+        concurrency = current_app.config.get('NORMALIZE_CONCURRENCY', 4)
+        timeout = current_app.config.get('NORMALIZE_TIMEOUT', 30)
+    background = {}
+    for index, (relation, ids, fields) in enumerate(jobs[1:], 1):
+        if len(background) >= concurrency - 1:
+            break
+        client = extra_connection()
+        if client is None:
+            break
+        background[index] = Background(
+            read_with, client, relation._name, ids, fields, context=context
+        )
+    results = []
+    for index, (relation, ids, fields) in enumerate(jobs):
+        if index not in background:
+            results.append(read_cached(relation, ids, fields, context=context))
+        else:
+            results.append(None)
+    for index, job in background.items():
+        results[index] = job.result(timeout)
+    return results
+
+
+def normalize(model, values, dump_schema=None, context=None):
+    return normalize_many(model, [values], dump_schema, context=context)[0]
+
+
+@metrics.timed('normalize')
+def normalize_many(model, items, dump_schema=None, context=None,
+                   identity_map=None):
+    """Normalize a page of records expanding its relations breadth first.
+
+    All the ids of the same relation and schema found in one level are
+    read together, so the number of reads depends on the schema and not on
+    the number of items. Records already read are taken from
+    `identity_map`, which can be shared between calls of the same request.
+    `dump_schema` is a tree of fields or a :class:`ReadPlan` of it.
+    """
+    plan = read_plan(model, dump_schema)
+    if identity_map is None:
+        identity_map = {}
+    result = [values.copy() for values in items]
+    level = [(model, result, plan)]
+    while level:
+        reads = collections.OrderedDict()
+        for model, rows, plan in level:
+            schema = plan.fields_def
+            for _values in rows:
+                for k, v in list(_values.items()):
+                    field_type = schema.get(k, {}).get('type')
+                    if field_type is None:
+                        continue
+                    elif field_type.endswith('2many') and not v:
+                        _values[k] = []
+                    elif field_type != 'boolean' and not v:
+                        _values[k] = None
+                    elif 'relation' in schema[k]:
+                        if field_type == 'many2one':
+                            v = v[0]
+                        sub_plan = plan.children.get(k)
+                        if sub_plan is None:
+                            if field_type == 'many2one':
+                                _values[k] = {'id': v}
+                            else:
+                                _values[k] = [dict(id=rel_id) for rel_id in v]
+                            continue
+                        read_key = sub_plan.key
+                        if read_key not in reads:
+                            reads[read_key] = {
+                                'relation': model.client.model(sub_plan.model),
+                                'plan': sub_plan,
+                                'ids': collections.OrderedDict(),
+                                'targets': []
+                            }
+                        read = reads[read_key]
+                        ids = [v] if field_type == 'many2one' else v
+                        for rel_id in ids:
+                            read['ids'][rel_id] = True
+                        read['targets'].append((_values, k, field_type, v))
+        level = []
+        jobs = []
+        for read_key, read in reads.items():
+            known = identity_map.setdefault(read_key, {})
+            read['missing'] = [x for x in read['ids'] if x not in known]
+            if read['missing']:
+                jobs.append((
+                    read['relation'], read['missing'], read['plan'].fields
+                ))
+        results = iter(fetch_reads(jobs, context=context))
+        for read_key, read in reads.items():
+            known = identity_map[read_key]
+            missing = read['missing']
+            if missing:
+                found = next(results)
+                rows = []
+                for rel_id in missing:
+                    if rel_id in found:
+                        known[rel_id] = found[rel_id].copy()
+                        rows.append(known[rel_id])
+                level.append((read['relation'], rows, read['plan']))
+            for _values, k, field_type, v in read['targets']:
+                if field_type == 'many2one':
+                    _values[k] = known.get(v, {'id': v})
                 else:
-                    for rel_id in rel_ids:
-                        _values[k].append(dict(id=rel_id))
-    return _values
+                    _values[k] = [known[x] for x in v if x in known]
+    return result
+
+
+def search_read(model, domain, fields, offset=0, limit=None, order=None):
+    """Search and read in one call when the server has ``search_read``."""
+    if float(model.client.major_version) >= 8.0:
+        return flights.call(
+            model, 'search_read', domain, fields, offset, limit or False,
+            order or False
+        )
+    ids = flights.call(
+        model, 'search', domain, offset=offset, limit=limit, order=order
+    )
+    if not ids:
+        return []
+    return [
+        x for x in flights.call(model, 'read', ids, fields, order=True) if x
+    ]
+
+
+def export_items(model, ids, dump_schema, chunk_size=500, context=None):
+    """Yield the normalized records of `ids` reading them in chunks."""
+    plan = read_plan(model, dump_schema)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        items = model.read(chunk, plan.fields, order=True, context=context)
+        items = [x for x in items or [] if x]
+        for values in normalize_many(model, items, plan, context=context):
+            yield values
+
+
+def dotted_value(values, field):
+    """Value of the dotted `field` in a normalized record."""
+    for name in field.split('.'):
+        if isinstance(values, list):
+            return [dotted_value(x, name) for x in values]
+        if not isinstance(values, dict):
+            return None
+        values = values.get(name)
+    return values
 
 
 def recursive_update(d, u):
     for k, v in u.items():
-        if isinstance(v, collections.Mapping):
+        if isinstance(v, Mapping):
             r = recursive_update(d.get(k, {}), v)
             d[k] = r
         else:
@@ -158,16 +497,22 @@ def recursive_update(d, u):
 
 
 def unflatdot(fields):
+    """Tree of the dotted `fields` built in one pass.
+
+    ``['a', 'b.c']`` is ``{'a': True, 'b': {'c': True}}``. A field with
+    subfields is a relation to expand, so ``a.b`` wins over ``a`` whatever
+    their order.
+    """
     schema = {}
-    for field in sorted(fields):
-        tree = field.split('.')
-        if len(tree) > 1:
-            k = tree[0]
-            v = ['.'.join(tree[1:])]
-            schema.setdefault(k, {})
-            recursive_update(schema[k], unflatdot(v))
-        else:
-            schema[field] = True
+    for field in fields:
+        node = schema
+        names = field.split('.')
+        for name in names[:-1]:
+            child = node.get(name)
+            if not isinstance(child, dict):
+                child = node[name] = {}
+            node = child
+        node.setdefault(names[-1], True)
     return schema
 
 
@@ -192,11 +537,14 @@ def flatdot(schema):
 
 
 def make_schema(model, fields, data=None):
+    return schema_from_tree(model, unflatdot(fields), data)
+
+
+def schema_from_tree(model, fields, data=None):
     if data is None:
         data = {}
-    fields = unflatdot(fields)
-    fields_def = model.fields_get()
-    defaults_fields = model.default_get(list(fields_def.keys()))
+    fields_def = get_fields(model)
+    defaults_fields = metadata.default_get(model, list(fields_def.keys()))
     schema = {}
     if 'id' not in fields_def:
         fields_def['id'] = {'type': 'integer'}
@@ -230,8 +578,10 @@ def make_schema(model, fields, data=None):
             if field not in fields:
                 rel_schema = {'id': {'type': 'integer'}}
             else:
-                rel_fields = flatdot(fields[field])
-                rel_schema = make_schema(relation, rel_fields)
+                rel_fields = fields[field]
+                if not isinstance(rel_fields, dict):
+                    rel_fields = {'id': True}
+                rel_schema = schema_from_tree(relation, rel_fields)
             if attrs['type'] == 'many2one':
                 if isinstance(data.get(field), dict):
                     type_ = 'dict'
@@ -261,17 +611,25 @@ class WSTransaction(object):
 
     def __init__(self):
         self.errors = []
+        self.touched = []
 
     def __enter__(self):
         self.client = g.backend_cnx
+        self.parent = g.get('backend_transaction')
         self.transaction = self.client.begin()
         g.backend_cnx = self.transaction
+        g.backend_transaction = self
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type or self.errors:
-            self.transaction.rollback()
-        else:
-            self.transaction.commit()
-        self.transaction.close()
-        g.backend_cnx = self.client
+        try:
+            if exc_type or self.errors:
+                self.transaction.rollback()
+            else:
+                self.transaction.commit()
+            self.transaction.close()
+        finally:
+            g.backend_cnx = self.client
+            g.backend_transaction = self.parent
+            for name, ids in self.touched:
+                cache.invalidate(name, ids)
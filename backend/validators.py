@@ -1,7 +1,12 @@
+from collections import OrderedDict
 from datetime import datetime
+import threading
 
 from cerberus import Validator
 
+from backend.metadata import metadata
+from backend.utils import flatdot, make_schema
+
 
 class OpenERPValidator(Validator):
 
@@ -27,3 +32,53 @@ class OpenERPValidator(Validator):
             return True
         except ValueError:
             pass
+
+
+class ValidatorCache(object):
+    """LRU of validation schemas already compiled by Cerberus.
+
+    Schemas are keyed by the metadata version, the user (required fields
+    depend on its defaults), the model and the set of fields sent. Every
+    request gets its own :class:`OpenERPValidator` built from the compiled
+    schema, which skips the schema validation done by Cerberus.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._schemas = OrderedDict()
+
+    def configure(self, config):
+        """Read the cache settings from a Flask config mapping."""
+        self.max_size = config.get('VALIDATOR_CACHE_SIZE', self.max_size)
+
+    @staticmethod
+    def calculate_key(model, fields):
+        client = model.client
+        return (
+            metadata.version(client), client._db, client.user, model._name,
+            tuple(sorted(fields))
+        )
+
+    def get_validator(self, model, data):
+        fields = flatdot(data)
+        key = self.calculate_key(model, fields)
+        with self._lock:
+            schema = self._schemas.pop(key, None)
+            if schema is not None:
+                self._schemas[key] = schema
+        if schema is not None:
+            return OpenERPValidator(schema)
+        validator = OpenERPValidator(make_schema(model, fields))
+        with self._lock:
+            self._schemas[key] = validator.schema
+            while len(self._schemas) > self.max_size:
+                self._schemas.popitem(last=False)
+        return validator
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+
+
+validators = ValidatorCache()
@@ -0,0 +1 @@
+"""Benchmarks of the backend against a stand-in PowERP."""
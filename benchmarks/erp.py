@@ -0,0 +1,177 @@
+"""Stand-in ERP XML-RPC server for the benchmarks.
+
+It serves the ``db``, ``common``, ``object`` and ``ws_transaction`` services
+used by erppeek and ERPPeek-WST with the models of :mod:`benchmarks.fake`,
+sleeping `latency` seconds in every call. Users log in with their login as
+password.
+
+    PYTHONPATH=. python benchmarks/erp.py --port 8069 --latency 0.005
+"""
+from __future__ import print_function
+import argparse
+import threading
+from itertools import count
+from time import sleep
+
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.xmlrpc_client import Fault
+from six.moves.xmlrpc_server import (
+    MultiPathXMLRPCServer, SimpleXMLRPCDispatcher, SimpleXMLRPCRequestHandler
+)
+
+from benchmarks.fake import FakeModel, FakeRecord, invoice_client
+
+VERSION = '5.0.14'
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadedServer(ThreadingMixIn, MultiPathXMLRPCServer):
+    daemon_threads = True
+
+
+def registry(client, version=VERSION):
+    """Add the ir.model and ir.module.module models erppeek reads."""
+    names = sorted(client._models)
+    client._models['ir.model'] = FakeModel(
+        client, 'ir.model', {'model': {'type': 'char'}},
+        dict((i, {'id': i, 'model': x}) for i, x in enumerate(names, 1))
+    )
+    client._models['ir.module.module'] = FakeModel(
+        client, 'ir.module.module', {
+            'name': {'type': 'char'},
+            'state': {'type': 'char'},
+            'latest_version': {'type': 'char'},
+        }, {1: {
+            'id': 1, 'name': 'base', 'state': 'installed',
+            'latest_version': version,
+        }}
+    )
+
+
+def result(value):
+    if isinstance(value, FakeRecord):
+        return value.id
+    return value
+
+
+class ERPServer(object):
+    """XML-RPC server of the models of a fake client."""
+
+    def __init__(self, client, database='bench', latency=0,
+                 host='127.0.0.1', port=0):
+        registry(client)
+        self.client = client
+        self.database = database
+        self.latency = latency
+        self.users = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._transactions = count(1)
+        self.server = ThreadedServer(
+            (host, port), requestHandler=RequestHandler, logRequests=False,
+            allow_none=True
+        )
+        services = {
+            'db': {'server_version': self.server_version, 'list': self.list},
+            'common': {'login': self.login},
+            'object': {'execute': self.execute},
+            'ws_transaction': {
+                'begin': self.begin,
+                'execute': self.execute_sync,
+                'commit': self.end,
+                'rollback': self.end,
+                'close_connection': self.end,
+                'get_transaction': self.end,
+            },
+        }
+        for name, methods in services.items():
+            dispatcher = SimpleXMLRPCDispatcher(allow_none=True)
+            for method_name, method in methods.items():
+                dispatcher.register_function(method, method_name)
+            self.server.add_dispatcher('/xmlrpc/' + name, dispatcher)
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def server_version(self):
+        return VERSION
+
+    def list(self):
+        return [self.database]
+
+    def login(self, db, user, password):
+        if db != self.database or user != password:
+            return False
+        with self._lock:
+            uid = self.users.setdefault(user, len(self.users) + 1)
+        return uid
+
+    def check(self, db, uid, password):
+        if db != self.database or self.users.get(password) != uid:
+            raise Fault('AccessDenied', 'Access denied')
+
+    def execute(self, db, uid, password, obj, method, *params):
+        self.check(db, uid, password)
+        if self.latency:
+            sleep(self.latency)
+        try:
+            model = self.client.model(obj)
+        except KeyError:
+            raise Fault('warning', 'Object {} does not exist'.format(obj))
+        if method.startswith('_') or not hasattr(model, method):
+            raise Fault('warning', 'Method {} does not exist'.format(method))
+        with self._lock:
+            self.calls += 1
+            return result(getattr(model, method)(*params))
+
+    def begin(self, db, uid, password):
+        self.check(db, uid, password)
+        return next(self._transactions)
+
+    def execute_sync(self, db, uid, password, transaction_id, obj, method,
+                     *params):
+        return self.execute(db, uid, password, obj, method, *params)
+
+    def end(self, db, uid, password, transaction_id):
+        """Commit, rollback or close, writes are never rolled back."""
+        self.check(db, uid, password)
+        return transaction_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8069)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--invoices', type=int, default=1000)
+    parser.add_argument('--lines', type=int, default=5)
+    args = parser.parse_args()
+    erp = ERPServer(
+        invoice_client(n_partners=100, n_lines=args.lines,
+                       n_invoices=args.invoices),
+        latency=args.latency, port=args.port
+    )
+    print('Serving database bench on {}/xmlrpc'.format(erp.url))
+    erp.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
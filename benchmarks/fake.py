@@ -0,0 +1,229 @@
+"""In process stand-in of an ERP client for the benchmarks."""
+import operator
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+    'like': lambda a, b: str(b) in str(a),
+    'ilike': lambda a, b: str(b).lower() in str(a).lower(),
+}
+
+
+def field_value(record, field):
+    value = record.get(field, False)
+    if isinstance(value, list) and len(value) == 2:
+        value = value[0]
+    return value
+
+
+def match(record, domain):
+    """Evaluate a domain in polish notation against a record."""
+    stack = []
+    for term in reversed(domain):
+        if term == '!':
+            stack.append(not stack.pop())
+        elif term in ('&', '|'):
+            a, b = stack.pop(), stack.pop()
+            stack.append(a and b if term == '&' else a or b)
+        else:
+            field, op, value = term
+            current = field_value(record, field)
+            if current is False and op in ('>', '>=', '<', '<='):
+                stack.append(False)
+            else:
+                stack.append(OPERATORS[op](current, value))
+    return all(stack)
+
+
+def sort_records(records, order):
+    records = list(records)
+    criteria = [x.split() for x in (order or 'id').split(',') if x.strip()]
+    for criterion in reversed(criteria):
+        field = criterion[0]
+        reverse = len(criterion) > 1 and criterion[1].lower() == 'desc'
+        nulls = [x for x in records if field_value(x, field) is False]
+        values = [x for x in records if field_value(x, field) is not False]
+        values.sort(key=lambda x: field_value(x, field), reverse=reverse)
+        records = nulls + values if reverse else values + nulls
+    return records
+
+
+class FakeRecord(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeModel(object):
+
+    def __init__(self, client, name, fields, records=None, defaults=None):
+        self.client = client
+        self._name = name
+        self.fields = fields
+        self.records = records or {}
+        self.defaults = defaults or {}
+
+    def fields_get(self, fields=None, context=None):
+        return dict((k, dict(v)) for k, v in self.fields.items())
+
+    def default_get(self, fields, context=None):
+        return dict((k, v) for k, v in self.defaults.items() if k in fields)
+
+    def search(self, domain, offset=0, limit=None, order=None, context=None):
+        records = [x for x in self.records.values() if match(x, domain)]
+        ids = [x['id'] for x in sort_records(records, order)]
+        return ids[offset:offset + limit if limit else None]
+
+    def create(self, vals, context=None):
+        if isinstance(vals, list):
+            return [self.create(x).id for x in vals]
+        new_id = max(self.records or [0]) + 1
+        self.records[new_id] = dict(vals, id=new_id)
+        return FakeRecord(new_id)
+
+    def write(self, ids, vals, context=None):
+        for x in ids:
+            self.records[x].update(vals)
+        return True
+
+    def unlink(self, ids, context=None):
+        for x in ids:
+            self.records.pop(x, None)
+        return True
+
+    def _execute(self, method, *params, **kwargs):
+        return getattr(self, method)(*params, **kwargs)
+
+    def search_read(self, domain, fields=None, offset=0, limit=None,
+                    order=None, context=None):
+        ids = self.search(domain, offset=offset, limit=limit, order=order)
+        return self.read(ids, fields)
+
+    def search_count(self, domain, context=None):
+        return len(self.search(domain))
+
+    def read(self, ids, fields=None, context=None, **kwargs):
+        single = not isinstance(ids, (list, tuple))
+        if single:
+            ids = [ids]
+        fields = list(fields or self.fields.keys())
+        res = [
+            dict((k, self.records[x].get(k, False)) for k in fields + ['id'])
+            for x in ids if x in self.records
+        ]
+        return res[0] if single else res
+
+
+class FakeClient(object):
+
+    _db = 'bench'
+    user = 'admin'
+    major_version = '5.0'
+
+    def __init__(self, server=None, db=None, user=None, password=None,
+                 models=None):
+        self._models = dict(
+            (name, FakeModel(self, name, **definition))
+            for name, definition in (models or {}).items()
+        )
+
+    def model(self, name):
+        return self._models[name]
+
+    transaction_id = None
+
+    def execute(self, obj, method, *params, **kwargs):
+        return getattr(self.model(obj), method)(*params, **kwargs)
+
+    def begin(self):
+        self.transaction_id = 1
+        return self
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.transaction_id = None
+
+    def read(self, obj, domain, fields):
+        return [{'name': 'base', 'latest_version': '5.0.1'}]
+
+
+def invoice_client(n_partners=10, n_lines=5, n_invoices=0):
+    """Client with invoices of `n_lines` lines, and partners."""
+    partners = dict(
+        (x, {'id': x, 'name': 'Partner {}'.format(x), 'vat': 'ES{}'.format(x)})
+        for x in range(1, n_partners + 1)
+    )
+    client = FakeClient(models={
+        'account.invoice': {
+            'fields': {
+                'number': {'type': 'char', 'size': 64},
+                'date_invoice': {'type': 'date'},
+                'state': {
+                    'type': 'selection', 'required': True,
+                    'selection': [('draft', 'Draft'), ('open', 'Open')],
+                },
+                'partner_id': {
+                    'type': 'many2one', 'relation': 'res.partner',
+                    'required': True,
+                },
+                'invoice_line': {
+                    'type': 'one2many', 'relation': 'account.invoice.line',
+                },
+                'amount_total': {'type': 'float', 'readonly': True},
+            },
+            'defaults': {'state': 'draft'},
+        },
+        'account.invoice.line': {
+            'fields': {
+                'name': {'type': 'char', 'size': 256, 'required': True},
+                'quantity': {'type': 'float'},
+                'price_unit': {'type': 'float'},
+                'partner_id': {
+                    'type': 'many2one', 'relation': 'res.partner',
+                },
+            },
+        },
+        'res.partner': {
+            'fields': {
+                'name': {'type': 'char', 'size': 128, 'required': True},
+                'vat': {'type': 'char', 'size': 32},
+            },
+            'records': partners,
+        },
+    })
+    populate(client, n_invoices, n_lines)
+    return client
+
+
+def populate(client, n_invoices, n_lines):
+    """Add `n_invoices` invoices with `n_lines` lines each."""
+    partners = sorted(client.model('res.partner').records)
+    invoices = client.model('account.invoice').records
+    lines = client.model('account.invoice.line').records
+    for x in range(len(invoices) + 1, len(invoices) + n_invoices + 1):
+        partner = partners[x % len(partners)]
+        partner_id = [partner, 'Partner {}'.format(partner)]
+        line_ids = list(range(len(lines) + 1, len(lines) + n_lines + 1))
+        for line_id in line_ids:
+            lines[line_id] = {
+                'id': line_id, 'name': 'Line {}'.format(line_id),
+                'quantity': 1.0, 'price_unit': 10.0, 'partner_id': partner_id,
+            }
+        invoices[x] = {
+            'id': x, 'number': 'F{:05d}'.format(x),
+            'date_invoice': '2017-01-01', 'state': 'open',
+            'partner_id': partner_id, 'invoice_line': line_ids,
+            'amount_total': 10.0 * n_lines,
+            '__last_update': '2017-01-01 00:00:00',
+        }
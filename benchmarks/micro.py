@@ -0,0 +1,90 @@
+"""Cost of the schema and record helpers with the in process fake ERP.
+
+    PYTHONPATH=. python benchmarks/micro.py
+"""
+from __future__ import print_function
+from timeit import repeat
+
+from benchmarks.fake import invoice_client
+from backend.cache import cache
+from backend.utils import (
+    ReadPlan, flatdot, make_schema, normalize_many, recursive_crud, unflatdot
+)
+
+NUMBER = 50
+REPEAT = 5
+
+client = invoice_client(n_partners=100, n_lines=5, n_invoices=80)
+invoices = client.model('account.invoice')
+fields = [
+    'number', 'state', 'date_invoice', 'partner_id.name',
+    'invoice_line.name', 'invoice_line.quantity',
+    'invoice_line.partner_id.name',
+]
+wide_fields = [
+    'field_{}.sub_{}.name'.format(x, y) for x in range(40) for y in range(5)
+]
+schema = unflatdot(fields)
+plan = ReadPlan(invoices, schema)
+page = invoices.read(sorted(invoices.records), list(schema.keys()))
+data = {
+    'number': 'F0001',
+    'date_invoice': '2017-01-01',
+    'partner_id': 1,
+    'invoice_line': [
+        {'name': 'Line {}'.format(x), 'quantity': 1.0, 'price_unit': 10.0}
+        for x in range(5)
+    ],
+}
+# Measure the reads, not the data cache
+cache.ttl = 0
+
+
+def bench_unflatdot():
+    unflatdot(fields)
+
+
+def bench_unflatdot_wide():
+    unflatdot(wide_fields)
+
+
+def bench_flatdot():
+    flatdot(data)
+
+
+def bench_make_schema():
+    make_schema(invoices, flatdot(data), data)
+
+
+def bench_normalize():
+    normalize_many(invoices, [dict(x) for x in page], schema)
+
+
+def bench_read_plan():
+    ReadPlan(invoices, schema)
+
+
+def bench_normalize_plan():
+    normalize_many(invoices, [dict(x) for x in page], plan)
+
+
+def bench_recursive_crud():
+    recursive_crud(invoices, dict(data))
+
+
+BENCHMARKS = [
+    ('unflatdot', bench_unflatdot),
+    ('unflatdot_wide', bench_unflatdot_wide),
+    ('flatdot', bench_flatdot),
+    ('make_schema', bench_make_schema),
+    ('read_plan', bench_read_plan),
+    ('normalize', bench_normalize),
+    ('normalize_plan', bench_normalize_plan),
+    ('recursive_crud', bench_recursive_crud),
+]
+
+
+if __name__ == '__main__':
+    for name, func in BENCHMARKS:
+        best = min(repeat(func, number=NUMBER, repeat=REPEAT)) / NUMBER
+        print('{:<15} {:>10.1f} us/call'.format(name, best * 1e6))
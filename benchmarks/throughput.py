@@ -0,0 +1,171 @@
+"""Throughput and latency of the API against the stand-in ERP server.
+
+Starts :mod:`benchmarks.erp` and the backend in local threads and runs every
+scenario with `--concurrency` clients, reporting requests per second, latency
+percentiles and upstream calls per request (``X-Upstream-Calls``).
+
+    PYTHONPATH=. python benchmarks/throughput.py --latency 0.002
+"""
+from __future__ import print_function
+import argparse
+import base64
+import json
+import threading
+from collections import OrderedDict
+from itertools import count
+from time import time
+
+from flask import Flask
+from six.moves.http_client import HTTPConnection
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from backend import Backend
+from benchmarks.erp import ERPServer
+from benchmarks.fake import invoice_client
+
+SCHEMA = ','.join([
+    'number', 'state', 'date_invoice', 'partner_id.name',
+    'invoice_line.name', 'invoice_line.quantity', 'invoice_line.partner_id.name',
+])
+
+SCENARIOS = OrderedDict([
+    ('auth', ('GET', '/token', None)),
+    ('model_get', (
+        'GET', '/account.invoice/{id}?schema=number,partner_id.name', None
+    )),
+    ('bunch_get', (
+        'GET', '/account.invoice?limit=80&offset={offset}&schema=' + SCHEMA,
+        None
+    )),
+    ('bunch_post', ('POST', '/account.invoice', {
+        'number': 'N{n}', 'partner_id': 1,
+        'invoice_line': [{'name': 'Line {n}', 'quantity': 1.0}],
+    })),
+    ('model_patch', ('PATCH', '/account.invoice/{id}', {'number': 'P{n}'})),
+])
+
+
+class RequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def format_body(body, **kwargs):
+    if isinstance(body, dict):
+        return dict((k, format_body(v, **kwargs)) for k, v in body.items())
+    if isinstance(body, list):
+        return [format_body(x, **kwargs) for x in body]
+    if isinstance(body, str):
+        return body.format(**kwargs)
+    return body
+
+
+def run(address, scenario, requests, concurrency, n_invoices, user='admin'):
+    method, path, body = SCENARIOS[scenario]
+    auth = base64.b64encode('{0}:{0}'.format(user).encode('utf-8'))
+    headers = {'Authorization': 'Basic ' + auth.decode('ascii')}
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+    counter = count()
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        connection = HTTPConnection(*address)
+        while True:
+            n = next(counter)
+            if n >= requests:
+                break
+            kwargs = {
+                'n': n, 'id': n % n_invoices + 1,
+                'offset': n * 80 % max(n_invoices - 80, 1),
+            }
+            data = body and json.dumps(format_body(body, **kwargs))
+            start = time()
+            connection.request(
+                method, path.format(**kwargs), body=data, headers=headers
+            )
+            response = connection.getresponse()
+            response.read()
+            duration = time() - start
+            calls = int(response.getheader('X-Upstream-Calls', 0))
+            with lock:
+                results.append((duration, calls, response.status))
+        connection.close()
+
+    start = time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - start
+    latencies = [x[0] * 1000 for x in results]
+    return OrderedDict([
+        ('scenario', scenario),
+        ('req/s', len(results) / elapsed),
+        ('p50 ms', percentile(latencies, 50)),
+        ('p90 ms', percentile(latencies, 90)),
+        ('p99 ms', percentile(latencies, 99)),
+        ('calls/req', float(sum(x[1] for x in results)) / len(results)),
+        ('errors', sum(1 for x in results if x[2] >= 400)),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='Seconds of latency of every ERP call')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--invoices', type=int, default=500)
+    parser.add_argument('--lines', type=int, default=5)
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS))
+    parser.add_argument('--config', default='{}',
+                        help='JSON with backend settings, i.e. '
+                             '{"DATA_CACHE_TTL": 0}')
+    args = parser.parse_args()
+
+    erp = ERPServer(
+        invoice_client(n_partners=100, n_lines=args.lines,
+                       n_invoices=args.invoices),
+        latency=args.latency
+    ).start()
+    app = Flask(__name__)
+    Backend(app, '/')
+    app.config.update(
+        SECRET_KEY='benchmark', OPENERP_SERVER=erp.url,
+        OPENERP_DATABASE=erp.database, **json.loads(args.config)
+    )
+    server = make_server(
+        '127.0.0.1', 0, app, threaded=True, request_handler=RequestHandler
+    )
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    columns = None
+    for scenario in args.scenario or list(SCENARIOS):
+        res = run(
+            server.server_address, scenario, args.requests, args.concurrency,
+            args.invoices
+        )
+        if columns is None:
+            columns = list(res)
+            print(''.join('{:>12}'.format(x) for x in columns))
+        print('{:>12}'.format(res['scenario']) + ''.join(
+            '{:>12.1f}'.format(res[x]) for x in columns[1:]
+        ))
+    server.shutdown()
+    erp.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Validation cost per POST request, with and without ValidatorCache.
+
+    PYTHONPATH=. python benchmarks/validation.py
+"""
+from __future__ import print_function
+from timeit import repeat
+
+from benchmarks.fake import invoice_client
+from backend.utils import flatdot, make_schema
+from backend.validators import OpenERPValidator, ValidatorCache
+
+NUMBER = 200
+
+client = invoice_client()
+model = client.model('account.invoice')
+data = {
+    'number': 'F0001',
+    'date_invoice': '2017-01-01',
+    'partner_id': 1,
+    'invoice_line': [
+        {'name': 'Line {}'.format(x), 'quantity': 1.0, 'price_unit': 10.0}
+        for x in range(5)
+    ],
+}
+cache = ValidatorCache()
+
+
+def uncached():
+    validator = OpenERPValidator(make_schema(model, flatdot(data)))
+    assert validator.validate(data), validator.errors
+
+
+def cached():
+    validator = cache.get_validator(model, data)
+    assert validator.validate(data), validator.errors
+
+
+if __name__ == '__main__':
+    for name, func in (('uncached', uncached), ('cached', cached)):
+        best = min(repeat(func, number=NUMBER, repeat=3)) / NUMBER
+        print('{:<10} {:>10.1f} us/request'.format(name, best * 1e6))
@@ -6,7 +6,7 @@ reqs = data.split()
 setup(
     name='backend',
     version='0.11.4',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     url='https://github.com/gisce/powerp-backend',
     license='MIT',
     author='GISCE-TI, S.L.',